@@ -15,18 +15,25 @@
 ###############################################################################################
 
 import tfi
+import framestore
+import preview
+import schedule
 import os
 import numpy as np
 import PIL.Image
 import tensorflow as tf
 import math
+import concurrent.futures
+import json
+import threading
+import time
 
-start_frame = 960
-end_frame = 1190
+start_frame = schedule.merge_start_frame
+end_frame = schedule.merge_end_frame
 
-directory = 'animation_merges'
-input_dir1 = 'animation_stage_01'
-input_dir2 = 'animation_stage_02'
+directory = preview.output_dir( 'animation_merges' )
+input_dir1 = preview.output_dir( 'animation_stage_01' )
+input_dir2 = preview.output_dir( 'animation_stage_02' )
 
 if not os.path.exists(directory):
     os.makedirs(directory)
@@ -35,17 +42,11 @@ if not os.path.exists(directory):
 # where the transformations are all self-consistent. In practice, this looks only slightly better
 # than a simple fade, and takes many hours to run. However, it *does* actually look better. I think
 # a longer overlap period may of looked even better, and/or some different choices of texture to
-# use on the overlapped section
-merge_end_percents = [100, 98, 96, 92, 84, 68, 50, 0]
-fwd_zoom = 0.997
-fwd_rot = 0.2
-back_zoom = 1.0/0.997
-back_rot = -0.2
+# use on the overlapped section. Mix ratios for every pass are set out in schedule.py
+merge_end_percents = schedule.merge_end_percents
+merge_rows = schedule.table( 'merge' )
 
-margin = 60
-
-def target_for_fno( fno ):
-    return tf.reduce_mean( tfi.T('mixed5a_3x3_bottleneck_pre_relu')[:,:,:,3] )
+margin = preview.scaled_pixels( 60 )
 
 def old_target_for_fno( fno ):
     layer = 'mixed5a_3x3_bottleneck_pre_relu'
@@ -53,102 +54,215 @@ def old_target_for_fno( fno ):
     channel_2 = 3
     if ( fno % 240 ) < 120:
         rt = (fno % 240)/120.0
-        rit = 1.0 - rt
-        target = tf.reduce_mean( rit * tfi.T(layer)[:,:,:,channel_1] + rt * tfi.T(layer)[:,:,:,channel_2] )
+        return tfi.blend_grad( layer, layer ), tfi.blend_feed( channel_1, channel_2, rt )
     else:
-        target = tf.reduce_mean( tfi.T(layer)[:,:,:,channel_2] )
-    return target
-
-def fwd_mix_ratio( fno, start_ratio, end_ratio ):
-    r = ( (fno - start_frame)/float(end_frame-start_frame) )
-    return ( 1 - r ) * start_ratio + r * end_ratio
-
-def back_mix_ratio( fno, start_ratio, end_ratio ):
-    r = 1.0 - ( (fno - start_frame)/float(end_frame-start_frame) )
-    return ( 1 - r ) * start_ratio + r * end_ratio
+        return tfi.objective_grad( layer, channel_2 ), None
 
-def process_image_step( current_img, zoom, rot, mix_ratio, mix_img, target ):
-    current_img = tfi.affine_zoom( current_img, zoom, rot )
-    current_img = tfi.mix_images( current_img, mix_img, mix_ratio )
-    return tfi.render_deepdream( target, current_img, iter_n=2, step=1.5, octave_n=4, octave_scale=1.5, direct_objective = True )
+def process_image_step( sweep, current_img, params, mix_img ):
+    mixed_img = tfi.affine_zoom( current_img, params['delta_zoom'], params['delta_rot'], out = sweep.frame_pool.take() )
+    tfi.mix_images( mixed_img, mix_img, params['mix'], out = mixed_img )
+    rendered_img = sweep.engine.render_scheduled( params, mixed_img )
+    sweep.frame_pool.give( mixed_img )
+    return rendered_img
 
 def make_reference_subdir( direction, pct ):
     subdname = '{}/{}_{}'.format( directory, direction, pct )
-    if not os.path.exists(subdname):
-        os.makedirs(subdname)
+    os.makedirs( subdname, exist_ok = True )
+
+# Reference frames are read from and written to the lossless state store. Overlap JPEGs are
+# still written for viewing, and read if a stage was rendered before the store existed. Each pass
+# reads every frame of the pass before exactly once, so frames are also kept in memory from when
+# they are rendered until the next pass takes them, up to the budget set by TFI_FRAME_CACHE_MB. The
+# store is then only read on resuming, or for frames that did not fit
+state_store = framestore.FrameStore( preview.output_dir( framestore.state_dir ) )
+frame_cache = framestore.FrameCache()
 
 def load_reference_img( direction, pct, fno ):
+    if frame_cache.has( direction, pct, fno ):
+        return frame_cache.take( direction, pct, fno )
+    if state_store.has( direction, pct, fno ):
+        return state_store.load( direction, pct, fno )
     if pct == 100:
         if direction == 'fwd':
-            return np.float32( PIL.Image.open( 'animation_stage_01/overlap_frame_{}.jpeg'.format( '%04d' % fno ) ) )
+            return np.float32( PIL.Image.open( '{}/overlap_frame_{}.jpeg'.format( input_dir1, '%04d' % fno ) ) )
         else:
-            return np.float32( PIL.Image.open( 'animation_stage_02/overlap_frame_{}.jpeg'.format( '%04d' % fno ) ) )
+            return np.float32( PIL.Image.open( '{}/overlap_frame_{}.jpeg'.format( input_dir2, '%04d' % fno ) ) )
     else:
         subdname = '{}_{}'.format( direction, pct )
         return np.float32( PIL.Image.open( '{}/{}/overlap_frame_{}.jpeg'.format( directory, subdname, '%04d' % fno ) ) )
 
 def save_reference_img( img, direction, pct, fno ):
+    state_store.save( img, direction, pct, fno )
+    # Nothing reads the last pass
+    if pct != merge_end_percents[-1]:
+        frame_cache.save( img, direction, pct, fno )
     subdname = '{}_{}'.format( direction, pct )
-    tfi.savejpeg( img, ('{}/{}/overlap_frame_{}.jpeg'.format( directory, subdname, '%04d' % fno ) ) )
+    tfi.savejpeg_async( img, ('{}/{}/overlap_frame_{}.jpeg'.format( directory, subdname, '%04d' % fno ) ) )
 
 def save_rendered_img( img, direction, pct, fno ):
     cropped_img = img[margin:-margin, margin:-margin, :]
     subdname = '{}_{}'.format( direction, pct )
-    tfi.savejpeg( cropped_img, ('{}/{}/frame_{}.jpeg'.format( directory, subdname, '%04d' % fno ) ) )
+    tfi.savejpeg_async( cropped_img, ('{}/{}/frame_{}.jpeg'.format( directory, subdname, '%04d' % fno ) ) )
 
-tfi.reset_graph_and_session()
-pass_id = 0
+# After each pass, the forward and back frames it rendered are compared. Once the mean absolute
+# difference between them, in 0-255 pixel levels over the cropped frames, is below
+# converged_difference, the remaining intermediate percentages would change little, so the merge
+# goes straight to the final pass. The final pass always runs, as it makes the frames used in the
+# video. Set TFI_MERGE_CONVERGED to 0 to run every pass. The difference after each pass is
+# appended to convergence.jsonl, which is also read on --resume so that the same passes are skipped
+converged_difference = float( os.environ.get( 'TFI_MERGE_CONVERGED', 1.0 ) )
+convergence_log = '{}/convergence.jsonl'.format( directory )
 
-for merge_end_id in range( len(merge_end_percents) -1 ):
-    pass_id += 1
+def load_pass_img( direction, pct, fno ):
+    '''Returns frame of a finished pass, leaving it in the cache for the next pass to take'''
+    if frame_cache.has( direction, pct, fno ):
+        return frame_cache.load( direction, pct, fno )
+    return state_store.load( direction, pct, fno )
 
-    prev_end_pct = merge_end_percents[merge_end_id]
-    this_end_pct = merge_end_percents[merge_end_id+1]
-    end_ratio = this_end_pct/100.0
-    start_ratio = 1.0 - 0.01 * (1.0 - end_ratio) # Varies from 1.0 to 0.99
+def pass_difference( pct ):
+    '''Returns mean and largest per-frame mean absolute difference between the forward and back
+    frames of a pass, for the frames that both sweeps render'''
+    differences = []
+    for fno in range( start_frame + 1, end_frame + 1 ):
+        fwd_img = load_pass_img( 'fwd', pct, fno )[margin:-margin, margin:-margin, :]
+        back_img = load_pass_img( 'back', pct, fno )[margin:-margin, margin:-margin, :]
+        differences.append( float( np.mean( np.abs( fwd_img - back_img ) ) ) )
+    return float( np.mean( differences ) ), max( differences )
+
+def read_convergence_log():
+    '''Returns dict of end percentage to logged difference, for passes finished before resuming'''
+    history = {}
+    if os.path.isfile( convergence_log ):
+        with open( convergence_log ) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads( line )
+                    history[ entry['pct'] ] = entry['difference']
+    return history
+
+def log_convergence( pass_id, prev_end_pct, this_end_pct, difference, largest ):
+    entry = { 'pass_id': pass_id, 'prev_pct': prev_end_pct, 'pct': this_end_pct, 'difference': difference,
+              'max_frame_difference': largest, 'time': time.time() }
+    with open( convergence_log, 'a' ) as f:
+        f.write( json.dumps( entry ) + '\n' )
+
+# Within a pass, the forward sweep only reads back frames of the previous pass and the back sweep
+# only reads forward frames, so the two sweeps of each pass run at the same time, in their own
+# threads with their own engine, frame buffers, random tile shifts and checkpoint. The next pass
+# starts once both have finished
+class Sweep(object):
+    '''State of the forward or back sweep, kept from one pass to the next'''
 
-    # Forward - always start from original reference
-    current_img = load_reference_img( 'fwd', 100, start_frame )
-    make_reference_subdir( 'fwd', this_end_pct )
-    save_reference_img( current_img, 'fwd', this_end_pct, start_frame )
-    save_rendered_img( current_img, 'fwd', this_end_pct, start_frame )
+    def __init__( self, direction, shape, threads ):
+        self.direction = direction
+        self.other = 'back' if direction == 'fwd' else 'fwd'
+        self.rows = schedule.select( merge_rows, 'merge_' + direction )
+        rng = np.random.RandomState()
+        self.engine = tfi.Engine( intra_op_threads = threads, inter_op_threads = tfi.default_inter_op_threads,
+                                  layers = schedule.layers( self.rows ), rng = rng )
+        # Warped and mixed frames go in a few reused buffers before rendering
+        self.frame_pool = tfi.FramePool( shape )
+        # Progress is saved every few frames. Run with --resume to continue from the last checkpoint
+        self.checkpoint = tfi.Checkpoint( directory, [ '{}_{}'.format( direction, pct ) for pct in merge_end_percents[1:] ],
+                                          name = direction, rng = rng )
 
-    for frame in range(end_frame-start_frame):
-        fno = start_frame + frame + 1
-        mix_img = load_reference_img( 'back', prev_end_pct, fno )
-        mix_ratio = fwd_mix_ratio( fno, start_ratio, end_ratio )
-        target = target_for_fno( fno )
+    def run( self, pass_id, prev_end_pct, this_end_pct ):
+        '''Renders this sweep of one pass, mixing in the other direction's frames from the pass before'''
+        direction = self.direction
+        rows = schedule.select( self.rows, 'merge_' + direction, pct = this_end_pct )
 
-        print('Merge 01 & 02, {} pass {}, frame {}, mix ratio {}'.format('fwd', pass_id, fno, mix_ratio))
+        # Always start from original reference
+        section = '{}_{}'.format( direction, this_end_pct )
+        first_fno = start_frame if direction == 'fwd' else end_frame + 1
+        if self.checkpoint.resumes_in( section ):
+            current_img = self.resumed[0]
+        elif not self.checkpoint.started( section ):
+            current_img = load_reference_img( direction, 100, first_fno )
+            make_reference_subdir( direction, this_end_pct )
+            save_reference_img( current_img, direction, this_end_pct, first_fno )
+            save_rendered_img( current_img, direction, this_end_pct, first_fno )
 
-        current_img = process_image_step( current_img, fwd_zoom, fwd_rot, mix_ratio, mix_img, target )
+        for frame in range(end_frame-start_frame):
+            if self.checkpoint.done( section, frame ):
+                continue
+            if stop_sweeps.is_set():
+                return
+            params = schedule.params( rows[frame] )
+            fno = params['fno']
+            mix_img = load_reference_img( self.other, prev_end_pct, fno )
 
-        save_reference_img( current_img, 'fwd', this_end_pct, fno )
-        save_rendered_img( current_img, 'fwd', this_end_pct, fno )
+            print('Merge 01 & 02, {} pass {}, frame {}, mix ratio {}'.format(direction, pass_id, fno, params['mix']))
 
-        if (frame % 5 == 0):
-            tfi.reset_graph_and_session()
+            current_img = process_image_step( self, current_img, params, mix_img )
 
-    # Back - always start from original reference
-    current_img = load_reference_img( 'back', 100, end_frame + 1 )
-    make_reference_subdir( 'back', this_end_pct )
-    save_reference_img( current_img, 'back', this_end_pct, end_frame + 1 )
-    save_rendered_img( current_img, 'back', this_end_pct, end_frame + 1 )
+            save_reference_img( current_img, direction, this_end_pct, fno )
+            save_rendered_img( current_img, direction, this_end_pct, fno )
+            tfi.flush_metrics( stage = directory, direction = direction, pass_id = pass_id, frame = fno )
+            self.checkpoint.save( section, frame, current_img )
 
-    for frame in range(end_frame-start_frame):
-        fno = end_frame - frame
-        mix_img = load_reference_img( 'fwd', prev_end_pct, fno )
-        mix_ratio = back_mix_ratio( fno, start_ratio, end_ratio )
-        target = target_for_fno( fno )
+# Set if either sweep fails, so that the other stops at its next frame
+stop_sweeps = threading.Event()
 
-        print('Merge 01 & 02, {} pass {}, frame {}, mix ratio {}'.format('back', pass_id, fno, mix_ratio))
+frame_shape = load_reference_img( 'fwd', 100, start_frame ).shape
+threads = max( 1, ( tfi.default_intra_op_threads or tfi.available_cores() ) // 2 )
+sweeps = [ Sweep( 'fwd', frame_shape, threads ), Sweep( 'back', frame_shape, threads ) ]
 
-        current_img = process_image_step( current_img, back_zoom, back_rot, mix_ratio, mix_img, target )
+# The gradient op is built and warmed up in each engine before the first frame. The two sweeps
+# run at the same time, so the merge takes about as long as the longer of their two estimates
+for sweep in sweeps:
+    sweep.engine.prepare( sweep.rows, frame_shape )
+    sweep.resumed = sweep.checkpoint.resume()
+# Metrics are kept per thread, so the setup of both engines is written out here, not by a sweep
+tfi.flush_metrics( stage = directory, section = 'prepare' )
 
-        save_reference_img( current_img, 'back', this_end_pct, fno )
-        save_rendered_img( current_img, 'back', this_end_pct, fno )
+if tfi.resume_requested():
+    history = read_convergence_log()
+else:
+    history = {}
+    if os.path.isfile( convergence_log ):
+        os.remove( convergence_log )
+
+workers = concurrent.futures.ThreadPoolExecutor( max_workers = len( sweeps ) )
+pass_id = 0
+merge_end_id = 0
+while merge_end_id < len(merge_end_percents) -1:
+    pass_id += 1
+
+    # After a skip, the pass before is the last one that ran, not the next percentage up the list
+    prev_end_pct = merge_end_percents[0] if pass_id == 1 else this_end_pct
+    this_end_pct = merge_end_percents[merge_end_id+1]
+
+    running = [ workers.submit( sweep.run, pass_id, prev_end_pct, this_end_pct ) for sweep in sweeps ]
+    for result in concurrent.futures.as_completed( running ):
+        if result.exception() is not None:
+            stop_sweeps.set()
+            raise result.exception()
+
+    tfi.flush_frames()
+    state_store.flush()
+
+    merge_end_id += 1
+    if merge_end_id < len(merge_end_percents) -1:
+        if this_end_pct in history:
+            difference = history[this_end_pct]
+        else:
+            difference, largest = pass_difference( this_end_pct )
+            log_convergence( pass_id, prev_end_pct, this_end_pct, difference, largest )
+            history[this_end_pct] = difference
+        print( 'Merge pass {} to {}%, mean difference between fwd and back frames {:.3f}'.format(
+            pass_id, this_end_pct, difference ) )
+        if difference < converged_difference:
+            print( 'Merge converged below {}, going straight to the final pass'.format( converged_difference ) )
+            merge_end_id = len(merge_end_percents) -2
 
-        if (frame % 5 == 0):
-            tfi.reset_graph_and_session()
+    # Only the latest pass is read from now on. Stage overlap frames are kept, as each pass
+    # starts from them, and the JPEG copies of every pass stay in place
+    if prev_end_pct != 100:
+        state_store.remove( 'fwd', prev_end_pct )
+        state_store.remove( 'back', prev_end_pct )
+    frame_cache.remove( 'fwd', prev_end_pct )
+    frame_cache.remove( 'back', prev_end_pct )
 
-tfi.close_session()
+workers.shutdown()
+for sweep in sweeps:
+    sweep.engine.close()
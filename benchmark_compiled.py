@@ -0,0 +1,67 @@
+###############################################################################################
+#   Copyright 2016, Neil Slater.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+###############################################################################################
+
+
+# Script compares speed and output of the plain gradient path with the compiled (XLA and/or
+# grappler rewrites) path, rendering the same frames from the same start image on the CPU
+
+import tfi
+import numpy as np
+import PIL.Image
+import time
+
+layer = 'mixed5a_3x3_bottleneck_pre_relu'
+channel = 3
+bench_frames = 10
+source_img = 'images/start_frame_1400x840.jpeg'
+
+modes = [
+    ( 'plain', {} ),
+    ( 'xla', { 'jit': True } ),
+    ( 'rewrites', { 'rewrites': True } ),
+    ( 'xla + rewrites', { 'jit': True, 'rewrites': True } ),
+]
+
+img0 = np.float32( PIL.Image.open( source_img ) )
+
+results = {}
+for name, options in modes:
+    engine = tfi.Engine( layers = [ layer ], tune_tiles = False, **options )
+    if options and not engine.compiled:
+        print( '{}: not available, timing the plain path instead'.format( name ) )
+    t_grad = engine.objective_grad( layer, channel )
+
+    # Warm up, so that graph setup and compilation are not counted
+    engine.render_grad( t_grad, img0, iter_n=1, step=1.5, octave_n=4, octave_scale=1.5 )
+
+    # Same random tile shifts for every mode, so differences come from the computation only
+    np.random.seed( 0 )
+    img = img0.copy()
+    start = time.time()
+    for frame in range(bench_frames):
+        img = engine.render_grad( t_grad, img, iter_n=1, step=1.5, octave_n=4, octave_scale=1.5 )
+    seconds = ( time.time() - start ) / bench_frames
+    engine.close()
+
+    results[name] = ( seconds, img )
+    print( '{}: {:.2f} seconds per frame, {:.0f} frames per hour'.format( name, seconds, 3600 / seconds ) )
+
+plain_seconds, plain_img = results['plain']
+for name, options in modes[1:]:
+    seconds, img = results[name]
+    drift = np.abs( img - plain_img )
+    print( '{}: speed-up {:.2f}x, drift after {} frames mean {:.4f} max {:.4f}'.format(
+        name, plain_seconds / seconds, bench_frames, drift.mean(), drift.max() ) )
@@ -0,0 +1,65 @@
+###############################################################################################
+#   Copyright 2016, Neil Slater.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+###############################################################################################
+
+
+# Script compares speed and output of the tiled render path with render_grad_in_graph, rendering
+# the same frames from the same start image with the settings of stages 2 and 3b. The in-graph
+# path is only used for sections listed in TFI_IN_GRAPH, see schedule.py, so run this to decide
+# whether its frames are close enough to the tiled ones to switch a stage over
+
+import tfi
+import numpy as np
+import PIL.Image
+import time
+
+layer = 'mixed5a_3x3_bottleneck_pre_relu'
+channel = 3
+bench_frames = 10
+source_img = 'images/start_frame_1400x840.jpeg'
+
+# Stage 2 renders one iteration per frame, stage 3b two
+settings = [ ( 'stage 2', 1 ), ( 'stage 3b', 2 ) ]
+
+img0 = np.float32( PIL.Image.open( source_img ) )
+
+engine = tfi.Engine( layers = [ layer ] )
+t_grad = engine.objective_grad( layer, channel )
+for name, iter_n in settings:
+    results = {}
+    for path, render in [ ( 'tiled', engine.render_grad ), ( 'in_graph', engine.render_grad_in_graph ) ]:
+        # Warm up, so that graph setup and tile tuning are not counted
+        render( t_grad, img0, iter_n=iter_n, step=1.5, octave_n=4, octave_scale=1.5 )
+
+        np.random.seed( 0 )
+        img = img0.copy()
+        first = None
+        start = time.time()
+        for frame in range(bench_frames):
+            img = render( t_grad, img, iter_n=iter_n, step=1.5, octave_n=4, octave_scale=1.5 )
+            if first is None:
+                first = img.copy()
+        seconds = ( time.time() - start ) / bench_frames
+        results[path] = ( seconds, first, img )
+        print( '{} {}: {:.2f} seconds per frame'.format( name, path, seconds ) )
+
+    tiled_seconds, tiled_first, tiled_img = results['tiled']
+    seconds, first, img = results['in_graph']
+    one_frame = np.abs( first - tiled_first )
+    drift = np.abs( img - tiled_img )
+    print( '{}: in_graph speed-up {:.2f}x, difference after 1 frame mean {:.4f} max {:.4f}, '
+           'after {} frames mean {:.4f} max {:.4f}'.format( name, tiled_seconds / seconds, one_frame.mean(),
+           one_frame.max(), bench_frames, drift.mean(), drift.max() ) )
+engine.close()
@@ -0,0 +1,67 @@
+###############################################################################################
+#   Copyright 2016, Neil Slater.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+###############################################################################################
+
+
+# Script checks renders at quarter preview scale, where only one octave is left. Each render must
+# return a new image and leave its input as it was, as the texture rings of stages 1 and 3a mix
+# the rendered frame back into its input through the ring mask, and the overlap and merge loops
+# give the input buffer back to their frame pool. Exits with an error if any render does not
+
+import preview
+import tfi
+import schedule
+import numpy as np
+import sys
+
+preview.set_scale( 0.25 )
+octave_n = preview.octaves( schedule.octave_n, schedule.octave_scale )
+print( 'Preview scale {}, {} octaves'.format( preview.scale, octave_n ) )
+
+img0 = preview.load_image( 'images/start_frame_1400x840.jpeg' )
+ring_img = tfi.ring_mask( img0, 700, 400 )
+
+rows = schedule.table( '01' )
+plain_row = schedule.params( rows[ rows['ring'] < 0 ][0] )
+ring_row = schedule.params( rows[ rows['ring'] >= 0 ][0] )
+engine = tfi.Engine( layers = schedule.layers( rows ), tune_tiles = False )
+
+failures = 0
+for name, row, roi in [ ( 'frame', plain_row, None ), ( 'texture ring', ring_row, ring_img ) ]:
+    img = img0.copy()
+    result = engine.render_scheduled( row, img, roi = roi )
+    problems = []
+    if np.shares_memory( result, img ):
+        problems.append( 'result is the input array' )
+    if not np.array_equal( img, img0 ):
+        problems.append( 'input was changed' )
+    if np.array_equal( result, img0 ):
+        problems.append( 'nothing was rendered' )
+    print( '{}: {}'.format( name, ', '.join( problems ) or 'OK' ) )
+    failures += len( problems )
+
+# With separate arrays, only pixels under the ring take the rendered texture
+img = img0.copy()
+mixed = tfi.masked_mix( img, engine.render_scheduled( ring_row, img, roi = ring_img ), ring_img, out = img )
+outside = ring_img < 1e-6
+if outside.any() and not np.allclose( mixed[outside], img0[outside], atol = 0.01 ):
+    print( 'texture ring mix: pixels outside the ring were changed' )
+    failures += 1
+engine.close()
+
+if failures:
+    print( 'FAIL: {} problems'.format( failures ) )
+    sys.exit( 1 )
+print( 'OK' )
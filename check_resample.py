@@ -0,0 +1,85 @@
+###############################################################################################
+#   Copyright 2016, Neil Slater.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+###############################################################################################
+
+
+# Script checks the float32 resampling in resample.py against skimage.transform.warp, which
+# tfi.affine_zoom and the octave resizes used before. Exits with an error if any case differs
+# by more than tolerance (on the 0-255 pixel scale), and prints timings for a full size frame
+
+import resample
+import numpy as np
+from skimage import transform
+import math
+import sys
+import time
+
+tolerance = 0.05
+
+def skimage_affine_zoom( img, zoom, spin = 0 ):
+    shift_y, shift_x, _ = (np.array(img.shape)-1) / 2.
+    shift_fwd = transform.SimilarityTransform(translation=[-shift_x, -shift_y])
+    shift_back = transform.SimilarityTransform(translation=[shift_x, shift_y])
+    affine = transform.AffineTransform( scale=(zoom, zoom), rotation=(spin * math.pi/180) )
+    return transform.warp( img.copy(), ( shift_fwd + ( affine + shift_back )).inverse, order=3,
+                     clip=False, preserve_range=True, mode='reflect').astype(np.float32)
+
+def skimage_resize( img, hw ):
+    # Same pixel centre mapping as transform.resize without anti-aliasing, written as a warp so
+    # that the result does not depend on the installed skimage version's resize defaults
+    height, width = img.shape[:2]
+    scale_y = height / float( hw[0] )
+    scale_x = width / float( hw[1] )
+    tform = transform.AffineTransform( scale=(scale_x, scale_y),
+                                       translation=(0.5 * scale_x - 0.5, 0.5 * scale_y - 0.5) )
+    return transform.warp( img, tform, output_shape=hw, order=3, clip=False,
+                           preserve_range=True, mode='reflect').astype(np.float32)
+
+np.random.seed( 0 )
+img = np.float32( np.random.uniform( 0, 255, ( 168, 280, 3 ) ) )
+
+worst = 0.0
+for zoom, spin in [ (1.0, 0), (0.997, 0.2), (1.0/0.994, -0.35), (1.05, 0.1), (0.9, 30), (1.3, -45) ]:
+    diff = np.abs( resample.affine_zoom( img, zoom, spin ) - skimage_affine_zoom( img, zoom, spin ) ).max()
+    worst = max( worst, diff )
+    print( 'affine_zoom zoom {:.4f} spin {:5.2f}: max diff {:.5f}'.format( zoom, spin, diff ) )
+
+for octave_scale in [ 1.4, 1.5 ]:
+    hw = tuple( int(x) for x in np.int32( np.float32( img.shape[:2] ) / octave_scale ) )
+    lo = resample.resize( img, hw )
+    for src, shape in [ ( img, hw ), ( lo, img.shape[:2] ) ]:
+        diff = np.abs( resample.resize( src, shape ) - skimage_resize( src, shape ) ).max()
+        worst = max( worst, diff )
+        print( 'resize {} to {}: max diff {:.5f}'.format( src.shape[:2], tuple( shape ), diff ) )
+
+# Best of five runs. The merge and stages 2 and 3b warp every frame by the same zoom and
+# rotation, so reuse the cached warp plan, while stages 1 and 3a change them every frame
+frame = np.float32( np.random.uniform( 0, 255, ( 840, 1400, 3 ) ) )
+zooms = iter( 0.997 + 0.0001 * np.arange( 100 ) )
+for name, fn in [ ( 'skimage warp', lambda: skimage_affine_zoom( frame, 0.997, 0.2 ) ),
+                  ( 'resample, same zoom', lambda: resample.affine_zoom( frame, 0.997, 0.2 ) ),
+                  ( 'resample, new zoom', lambda: resample.affine_zoom( frame, next( zooms ), 0.2 ) ) ]:
+    fn()
+    runs = []
+    for i in range(5):
+        start = time.time()
+        fn()
+        runs.append( time.time() - start )
+    print( '{} affine_zoom 1400x840: {:.3f} seconds'.format( name, min( runs ) ) )
+
+if worst > tolerance:
+    print( 'FAIL: max diff {:.5f} is over tolerance {}'.format( worst, tolerance ) )
+    sys.exit( 1 )
+print( 'OK: max diff {:.5f}'.format( worst ) )
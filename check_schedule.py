@@ -0,0 +1,307 @@
+###############################################################################################
+#   Copyright 2016, Neil Slater.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+###############################################################################################
+
+
+# Script checks the frame table in schedule.py against the per-frame formulas that the stage
+# scripts used inline before the table existed. For every frame of every section, it lists the
+# image operations the old loop did (warps, mixes, renders, texture rings and clearing circles),
+# in order, and the operations the stage scripts now do from the table row, and exits with an
+# error if any frame differs. The old formulas are copied here with their own constants. Only the
+# target lists are shared with schedule.py, as they were moved there unchanged. Requires only numpy
+
+import schedule
+import math
+import sys
+
+tolerance = 1e-9
+
+def mean_key( layer, channel ):
+    return ( layer, channel, 'mean' )
+
+def plain_renderer( section ):
+    '''Renderer that the table should give plain (not ring) renders of section'''
+    return 'in_graph' if section in schedule.in_graph_sections else 'tiled'
+
+# Old formulas
+
+def old_rings( pattern_step, target_a, target_b, clear_b = True ):
+    '''Texture rings and clearing circles of stages 1 and 3a, as add_texture_ring and
+    add_clearing_circle did them'''
+    ops = []
+    def texture_ring( offset, target ):
+        if pattern_step >= offset and pattern_step < offset + 45:
+            ops.append( ( 'ring', pattern_step - offset, mean_key( *target ), 3, 1.5 ) )
+    def clearing_circle( offset, weight ):
+        if pattern_step >= offset and pattern_step < offset + 45:
+            ops.append( ( 'circle', pattern_step - offset, weight ) )
+        elif pattern_step >= offset + 45 and pattern_step < offset + 45 + 4:
+            ops.append( ( 'fill', weight ) )
+    texture_ring( 30, target_a )
+    clearing_circle( 45, 0.05 )
+    clearing_circle( 60, 0.1 )
+    texture_ring( 120, target_b )
+    if clear_b:
+        clearing_circle( 135, 0.05 )
+        clearing_circle( 150, 0.1 )
+    return ops
+
+def old_stage_01():
+    targets = schedule.stage_01_targets
+    frames = []
+    for frame in range(960):
+        fno = frame + 1
+        section_id = ( fno // ( 240 // 2 ) )
+        target = ( targets[ section_id * 2 ], targets[ section_id * 2 + 1 ] )
+        pattern_step = fno % 240
+
+        delta_rot = ( 0.02 + section_id * 0.0025 ) * ( 0.5 * math.sin( fno / 23.0 ) + math.sin( fno / 37.0 ) )
+        delta_zoom = 1.0 - ( 0.0002 + section_id * 0.000025 ) *  ( 0.5 * math.sin( fno / 17.0 ) + math.sin( fno / 26.0 ) )
+        if fno > 930:
+            rat = (960 - fno)/float(960-930)
+            delta_rot = rat * delta_rot  + (1-rat) * 0.2
+            delta_zoom = rat * delta_zoom  + (1-rat) * 0.997
+
+        ops = [ ( 'warp', delta_zoom, delta_rot ) ] + old_rings( pattern_step, target, target, fno < 850 )
+        frames.append( ( fno, ops ) )
+    return frames
+
+def old_stage_01_overlap():
+    targets = schedule.stage_01_targets
+    frames = []
+    for frame in range(960, 1200):
+        fno = frame + 1
+        section_id = 7
+        layer_1 = targets[ section_id  * 2 + 2]
+        channel_1 = targets[ section_id * 2 + 3]
+        layer_2 = 'mixed5a_3x3_bottleneck_pre_relu'
+        channel_2 = 3
+        if ( fno % 240 ) < 120:
+            render = ( ( layer_1, layer_2, 'blend' ), ( channel_1, channel_2, (fno - 960)/120.0 ) )
+        else:
+            render = ( mean_key( layer_2, channel_2 ), None )
+
+        delta_rot = 0.2
+        delta_zoom = 0.997
+        if ( fno % 240 ) > 230:
+            delta_rot *= ( 240 - ( fno % 240 ) ) / 10.0
+        if fno > 980 and ( fno % 240 ) < 10:
+            delta_rot *= ( fno % 240 ) / 10.0
+
+        ops = [ ( 'warp', delta_zoom, delta_rot ), ( 'mix', 'ref', 0.998 ), ( 'mix', 'end_colours', 0.99 ),
+                ( 'render', ) + render + ( 1, 1.5, 'tiled' ) ]
+        frames.append( ( fno, ops ) )
+    return frames
+
+def old_stage_02():
+    targets = schedule.stage_02_targets
+    slow_zoom = 1.0/0.997
+    slow_rot = 0.2
+    fast_zoom = 1.0/0.994
+    fast_rot = 0.35
+    frames = []
+    for frame in range(4800 - 960 - 1):
+        fno = 4800 - 1 - frame
+        section_id = ( fno // 240 )
+        prev_layer = targets[ (section_id-1)  * 2 ]
+        prev_channel = targets[ (section_id-1) * 2 + 1]
+        layer = targets[ section_id  * 2 ]
+        channel = targets[ section_id * 2 + 1]
+        if ( fno % 240 ) < 120:
+            render = ( ( prev_layer, layer, 'blend' ), ( prev_channel, channel, (fno % 240)/120.0 ) )
+        else:
+            render = ( mean_key( layer, channel ), None )
+
+        rot = slow_rot
+        zoom = slow_zoom
+        if section_id >= 8:
+            rot = fast_rot
+            zoom = fast_zoom
+        elif section_id == 7:
+            rot = 0.75 * fast_rot + 0.25 * slow_rot
+            zoom = 0.75 * fast_zoom + 0.25 * slow_zoom
+        elif section_id == 6:
+            rot = 0.5 * fast_rot + 0.5 * slow_rot
+            zoom = 0.5 * fast_zoom + 0.5 * slow_zoom
+        elif section_id == 5:
+            rot = 0.25 * fast_rot + 0.75 * slow_rot
+            zoom = 0.25 * fast_zoom + 0.75 * slow_zoom
+        if ( fno % 480 ) < 240:
+            rot = -rot
+        if ( fno > 970 ):
+            if ( fno % 240 ) < 10:
+                rot *= ( fno % 240 )/10.0
+            if ( fno % 240 ) > 230:
+                rot *= ( 240 - ( fno % 240 ) ) / 10.0
+
+        step_val = 1.25
+        if (fno > 4600):
+            step_val = 0.5 + 0.75 * (4800 - fno)/200.0
+
+        ops = [ ( 'mix', 'guide_{}'.format( section_id % 4 ), 0.997 ), ( 'warp', zoom, rot ),
+                ( 'render', ) + render + ( 1, step_val, plain_renderer( '02' ) ) ]
+        frames.append( ( fno, ops ) )
+    return frames
+
+def old_stage_03a():
+    targets = schedule.stage_03_targets
+    frames = []
+    for frame in range(4800, 5040):
+        fno = frame + 1
+        pattern_step = fno % 240
+        delta_rot = ( 0.04 ) * ( 0.5 * math.sin( pattern_step / 21.0 ) + math.sin( pattern_step / 35.0 ) )
+        delta_zoom = 1.0 - ( 0.0003 ) *  ( 0.5 * math.sin( pattern_step / 15.0 ) + math.sin( pattern_step / 23.0 ) )
+        ops = [ ( 'warp', delta_zoom, delta_rot ) ] + old_rings( pattern_step, targets[0:2], targets[2:4] )
+        frames.append( ( fno, ops ) )
+    return frames
+
+def old_stage_03b():
+    targets = schedule.stage_03_targets
+    start_frame = 5040
+    end_frame = 5445
+    frames = []
+    for frame in range(start_frame, end_frame):
+        fno = frame + 1
+        section_id = ( (fno - start_frame) // 30 ) + 2
+        r = (fno - start_frame)/(end_frame - start_frame)
+        mix_amount = 0.99 * (1-r) + 0.96 * r
+        ops = [ ( 'warp', 1.05, 0.1 ), ( 'mix', 'end_colours', mix_amount ),
+                ( 'render', mean_key( targets[ section_id * 2 ], targets[ section_id * 2 + 1 ] ), None,
+                  2, 1.5, plain_renderer( '03b' ) ) ]
+        if (fno > 5400):
+            ops.append( ( 'mix', 'black', 1.0 - (fno - 5400)/45.0 ) )
+        if (fno > 5430):
+            ops.append( ( 'mix', 'credits', 1.0 - (fno - 5430)/15.0 ) )
+        frames.append( ( fno, ops ) )
+    return frames
+
+def old_merge( direction ):
+    start_frame = 960
+    end_frame = 1190
+    merge_end_percents = [100, 98, 96, 92, 84, 68, 50, 0]
+    frames = []
+    for merge_end_id in range( len(merge_end_percents) -1 ):
+        prev_end_pct = merge_end_percents[merge_end_id]
+        this_end_pct = merge_end_percents[merge_end_id+1]
+        end_ratio = this_end_pct/100.0
+        start_ratio = 1.0 - 0.01 * (1.0 - end_ratio)
+        for frame in range(end_frame-start_frame):
+            if direction == 'fwd':
+                fno = start_frame + frame + 1
+                r = ( (fno - start_frame)/float(end_frame-start_frame) )
+                other, zoom, rot = 'back', 0.997, 0.2
+            else:
+                fno = end_frame - frame
+                r = 1.0 - ( (fno - start_frame)/float(end_frame-start_frame) )
+                other, zoom, rot = 'fwd', 1.0/0.997, -0.2
+            mix_ratio = ( 1 - r ) * start_ratio + r * end_ratio
+            ops = [ ( 'warp', zoom, rot ), ( 'mix', '{}_{}'.format( other, prev_end_pct ), mix_ratio ),
+                    ( 'render', mean_key( 'mixed5a_3x3_bottleneck_pre_relu', 3 ), None, 2, 1.5, 'tiled' ) ]
+            frames.append( ( ( this_end_pct, fno ), ops ) )
+    return frames
+
+# Operations as the stage scripts now do them from the table
+
+def scheduled_render( params ):
+    key = schedule.objective_key( params )
+    feed = None
+    if key[2] == 'blend':
+        feed = ( params['channel_1'], params['channel_2'], params['blend'] )
+    return ( 'render', key, feed, params['iter_n'], params['step'], schedule.renderers[ params['renderer'] ] )
+
+def scheduled_rings( params ):
+    ops = []
+    if params['ring'] >= 0:
+        ops.append( ( 'ring', params['ring'], schedule.objective_key( params ), params['iter_n'], params['step'] ) )
+        if schedule.renderers[ params['renderer'] ] != 'ring':
+            ops.append( ( 'not a ring renderer', ) )
+    for ring_id, weight in zip( params['clear'], schedule.clear_weights ):
+        if ring_id >= schedule.ring_stages:
+            ops.append( ( 'fill', weight ) )
+        elif ring_id >= 0:
+            ops.append( ( 'circle', ring_id, weight ) )
+    return ops
+
+def table_frames( section ):
+    frames = []
+    for row in schedule.table( section ):
+        params = schedule.params( row )
+        fno = params['fno']
+        warp = ( 'warp', params['delta_zoom'], params['delta_rot'] )
+        if section in ( '01', '03a' ):
+            if params['objective'] >= 0 and params['ring'] < 0:
+                ops = [ warp, ( 'render without a ring', ) ]
+            else:
+                ops = [ warp ] + scheduled_rings( params )
+        elif section == '01_overlap':
+            ops = [ warp, ( 'mix', 'ref', 0.998 ), ( 'mix', 'end_colours', 0.99 ), scheduled_render( params ) ]
+        elif section == '02':
+            ops = [ ( 'mix', 'guide_{}'.format( params['guide'] ), params['mix'] ), warp, scheduled_render( params ) ]
+        elif section == '03b':
+            ops = [ warp, ( 'mix', 'end_colours', params['mix'] ), scheduled_render( params ) ]
+            if params['fade'] < 1.0:
+                ops.append( ( 'mix', 'black', params['fade'] ) )
+            if params['credits'] < 1.0:
+                ops.append( ( 'mix', 'credits', params['credits'] ) )
+        frames.append( ( fno, ops ) )
+    return frames
+
+def table_merge( direction ):
+    rows = schedule.select( schedule.table( 'merge' ), 'merge_' + direction )
+    other = 'back' if direction == 'fwd' else 'fwd'
+    frames = []
+    for row in rows:
+        params = schedule.params( row )
+        ops = [ ( 'warp', params['delta_zoom'], params['delta_rot'] ),
+                ( 'mix', '{}_{}'.format( other, params['prev_pct'] ), params['mix'] ), scheduled_render( params ) ]
+        frames.append( ( ( params['pct'], params['fno'] ), ops ) )
+    return frames
+
+def same( a, b ):
+    '''True if a and b are equal, with numbers equal to within tolerance'''
+    if isinstance( a, ( tuple, list ) ) and isinstance( b, ( tuple, list ) ):
+        return len( a ) == len( b ) and all( same( x, y ) for x, y in zip( a, b ) )
+    if isinstance( a, float ) or isinstance( b, float ):
+        return isinstance( a, ( int, float ) ) and isinstance( b, ( int, float ) ) and abs( a - b ) <= tolerance
+    return a == b
+
+checks = [
+    ( '01', old_stage_01(), table_frames( '01' ) ),
+    ( '01_overlap', old_stage_01_overlap(), table_frames( '01_overlap' ) ),
+    ( '02', old_stage_02(), table_frames( '02' ) ),
+    ( '03a', old_stage_03a(), table_frames( '03a' ) ),
+    ( '03b', old_stage_03b(), table_frames( '03b' ) ),
+    ( 'merge_fwd', old_merge( 'fwd' ), table_merge( 'fwd' ) ),
+    ( 'merge_back', old_merge( 'back' ), table_merge( 'back' ) ),
+]
+
+failures = 0
+for section, expected, scheduled in checks:
+    differences = 0
+    if len( expected ) != len( scheduled ):
+        print( '{}: {} frames in table, expected {}'.format( section, len( scheduled ), len( expected ) ) )
+        differences += 1
+    for ( old_fno, old_ops ), ( fno, ops ) in zip( expected, scheduled ):
+        if not same( old_fno, fno ) or not same( old_ops, ops ):
+            if differences < 5:
+                print( '{} frame {}:\n  expected {}\n  table    {}'.format( section, old_fno, old_ops, ops ) )
+            differences += 1
+    print( '{}: {} frames, {}'.format( section, len( expected ), '{} differ'.format( differences ) if differences else 'OK' ) )
+    failures += differences
+
+if failures:
+    print( 'FAIL: {} differences'.format( failures ) )
+    sys.exit( 1 )
+print( 'OK' )
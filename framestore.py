@@ -0,0 +1,151 @@
+###############################################################################################
+#   Copyright 2016, Neil Slater.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+###############################################################################################
+
+# Full resolution state frames (the uncropped images that later stages continue from or mix
+# with), stored without JPEG loss. Frames are indexed by direction, pass and frame number, and
+# kept in memory-mapped .npy chunks of chunk_frames consecutive frames, with a small flags file
+# per chunk recording which frames have been written. Reading a frame is a copy out of the page
+# cache, with no decoding. FrameCache holds frames that are about to be read again in memory as well,
+# up to a set budget
+
+import numpy as np
+import os
+import threading
+
+state_dir = 'state_frames'
+chunk_frames = 16
+
+# Memory budget and storage type of FrameCache. float16 fits twice as many frames, but rounds
+# values over 128 to the nearest 1/8
+cache_budget_mb = int( os.environ.get( 'TFI_FRAME_CACHE_MB', 8192 ) )
+cache_dtype = os.environ.get( 'TFI_FRAME_CACHE_DTYPE', 'float32' )
+
+class FrameStore(object):
+    '''Memory-mapped store of float32 (or float16, to halve disk use) frames in directory'''
+
+    def __init__( self, directory = state_dir, dtype = np.float32 ):
+        self.directory = directory
+        self.dtype = np.dtype( dtype )
+        self.chunks = {}
+        if not os.path.isdir( directory ):
+            os.makedirs( directory, exist_ok = True )
+
+    def chunk_name( self, direction, pass_id, fno ):
+        return os.path.join( self.directory, '{}_{}_{:05d}'.format( direction, pass_id, fno // chunk_frames ) )
+
+    def chunk( self, direction, pass_id, fno, shape = None ):
+        '''Returns (frames, flags) memory maps for the chunk holding fno. If the chunk does not
+        exist, it is created for frames of shape, or None is returned if shape is not given'''
+        name = self.chunk_name( direction, pass_id, fno )
+        chunk = self.chunks.get( name )
+        if chunk is not None:
+            return chunk
+        if os.path.isfile( name + '_flags.npy' ):
+            chunk = ( np.load( name + '.npy', mmap_mode = 'r+' ), np.load( name + '_flags.npy', mmap_mode = 'r+' ) )
+        elif shape is None:
+            return None
+        else:
+            # Flags are created last, so a chunk only counts as existing once both files do
+            frames = np.lib.format.open_memmap( name + '.npy', mode = 'w+', dtype = self.dtype,
+                                                shape = ( chunk_frames, ) + tuple( shape ) )
+            flags = np.lib.format.open_memmap( name + '_flags.npy', mode = 'w+', dtype = np.bool_,
+                                               shape = ( chunk_frames, ) )
+            chunk = ( frames, flags )
+        self.chunks[name] = chunk
+        return chunk
+
+    def save( self, img, direction, pass_id, fno ):
+        '''Stores img as frame fno of direction and pass_id'''
+        frames, flags = self.chunk( direction, pass_id, fno, img.shape )
+        frames[fno % chunk_frames] = img
+        flags[fno % chunk_frames] = True
+
+    def has( self, direction, pass_id, fno ):
+        chunk = self.chunk( direction, pass_id, fno )
+        return chunk is not None and bool( chunk[1][fno % chunk_frames] )
+
+    def load( self, direction, pass_id, fno ):
+        '''Returns a float32 copy of frame fno of direction and pass_id'''
+        if not self.has( direction, pass_id, fno ):
+            raise KeyError( 'No state frame {} for {} pass {}'.format( fno, direction, pass_id ) )
+        frames, flags = self.chunk( direction, pass_id, fno )
+        return np.array( frames[fno % chunk_frames], dtype = np.float32 )
+
+    def flush( self ):
+        '''Writes changed frames through to disk'''
+        for frames, flags in self.chunks.values():
+            frames.flush()
+            flags.flush()
+
+    def remove( self, direction, pass_id ):
+        '''Deletes all frames of direction and pass_id'''
+        prefix = '{}_{}_'.format( direction, pass_id )
+        for name in list( self.chunks ):
+            if os.path.basename( name ).startswith( prefix ):
+                del self.chunks[name]
+        for filename in os.listdir( self.directory ):
+            if filename.startswith( prefix ):
+                os.remove( os.path.join( self.directory, filename ) )
+
+class FrameCache(object):
+    '''In-memory copies of frames, indexed like FrameStore, for frames that are read back once
+    soon after they are saved. Frames are kept as dtype, using at most budget_mb of memory, and
+    frames that would go over the budget are not kept. Frames can be saved and taken from
+    several threads at once'''
+
+    def __init__( self, budget_mb = cache_budget_mb, dtype = cache_dtype ):
+        self.budget = budget_mb * 1048576
+        self.dtype = np.dtype( dtype )
+        self.frames = {}
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def save( self, img, direction, pass_id, fno ):
+        '''Keeps a copy of img as frame fno of direction and pass_id, if there is room. Returns
+        True if it was kept'''
+        key = ( direction, pass_id, fno )
+        with self.lock:
+            old = self.frames.pop( key, None )
+            if old is not None:
+                self.used -= old.nbytes
+            if self.used + img.size * self.dtype.itemsize > self.budget:
+                return False
+            self.used += img.size * self.dtype.itemsize
+        # Space is reserved first, so the copy can be made without holding the lock
+        frame = img.astype( self.dtype )
+        with self.lock:
+            self.frames[key] = frame
+        return True
+
+    def has( self, direction, pass_id, fno ):
+        return ( direction, pass_id, fno ) in self.frames
+
+    def load( self, direction, pass_id, fno ):
+        '''Returns a float32 copy of frame fno of direction and pass_id, which stays in the cache'''
+        return self.frames[ ( direction, pass_id, fno ) ].astype( np.float32 )
+
+    def take( self, direction, pass_id, fno ):
+        '''Returns frame fno of direction and pass_id as float32, and frees its memory'''
+        with self.lock:
+            frame = self.frames.pop( ( direction, pass_id, fno ) )
+            self.used -= frame.nbytes
+        return frame.astype( np.float32, copy = False )
+
+    def remove( self, direction, pass_id ):
+        '''Frees all frames of direction and pass_id'''
+        with self.lock:
+            for key in [ key for key in self.frames if key[:2] == ( direction, pass_id ) ]:
+                self.used -= self.frames.pop( key ).nbytes
@@ -10,7 +10,7 @@ out_name = 'images/start_frame_1400x840.jpeg'
 img0 = PIL.Image.open(in_name)
 img0 = np.float32(img0)
 
-tfi.reset_graph_and_session()
+tfi.reset_graph_and_session( layers = [ 'mixed4c' ] )
 
 target = tf.square( tfi.T('mixed4c') )
 
@@ -0,0 +1,99 @@
+###############################################################################################
+#   Copyright 2016, Neil Slater.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+###############################################################################################
+
+# Blurred circle and ring masks, as single-channel float32 arrays of height x width. A disc of
+# radius R blurred by a Gaussian of width sigma has a value at distance d from the centre equal
+# to the chance that a 2D normal sample centred d away lands inside the disc, which is the
+# non-central chi-squared CDF. That profile is computed once per mask along a fine radial grid
+# and interpolated, instead of filtering a drawn disc. Masks are saved in mask_cache_dir so that
+# all stages and reruns share them. scipy is only imported when a mask is made or an active
+# region found, as importing it takes most of a second and tfi imports this module
+
+import resample
+import numpy as np
+import os
+
+mask_cache_dir = 'mask_cache'
+active_threshold = 1e-3
+profile_step = 0.25
+distance_cache = {}
+
+def centre_distance( shape ):
+    '''Returns float32 distance of every pixel from the image centre, cached per height and width'''
+    key = tuple( shape[:2] )
+    distance = distance_cache.get( key )
+    if distance is None:
+        height, width = key
+        rows = np.arange( height, dtype=np.float32 ) - np.float32( ( height - 1 ) / 2. )
+        cols = np.arange( width, dtype=np.float32 ) - np.float32( ( width - 1 ) / 2. )
+        distance = np.sqrt( rows[:, np.newaxis] ** 2 + cols[np.newaxis, :] ** 2 )
+        distance_cache[key] = distance
+    return distance
+
+def blurred_disc_profile( radius, sigma, distances ):
+    '''Returns value of a disc of radius blurred by a Gaussian of width sigma, at each distance
+    from its centre'''
+    if radius <= 0:
+        return np.zeros_like( distances )
+    from scipy import stats
+    return stats.ncx2.cdf( ( radius / sigma ) ** 2, 2, ( distances / sigma ) ** 2 )
+
+def mask_cache_file( shape, radius, sigma ):
+    return os.path.join( mask_cache_dir, 'circle_{}x{}_r{:.3f}_s{:.3f}.npy'.format(
+        shape[0], shape[1], float( radius ), float( sigma ) ) )
+
+def circle_mask( shape, radius, sigma = 20 ):
+    '''Returns blurred circle mask centred in an image of shape (only height and width are used),
+    loaded from the mask cache if it has been made before'''
+    filename = mask_cache_file( shape, radius, sigma )
+    if os.path.isfile( filename ):
+        return np.load( filename )
+
+    distance = centre_distance( shape )
+    radial_grid = np.arange( 0, distance.max() + 2 * profile_step, profile_step )
+    profile = blurred_disc_profile( radius, sigma, radial_grid )
+    mask = np.interp( distance.ravel(), radial_grid, profile ).astype( np.float32 )
+    mask = mask.reshape( distance.shape )
+
+    # Write to a temporary file first, so that an interrupted or concurrent run never sees a
+    # partial mask
+    if not os.path.isdir( mask_cache_dir ):
+        os.makedirs( mask_cache_dir, exist_ok = True )
+    tmp_filename = '{}.{}.tmp.npy'.format( filename[:-4], os.getpid() )
+    np.save( tmp_filename, mask )
+    os.replace( tmp_filename, filename )
+    return mask
+
+def ring_mask( shape, outer_radius, inner_radius, sigma = 20 ):
+    '''Returns blurred ring mask, as the difference between two cached circle masks'''
+    return circle_mask( shape, outer_radius, sigma ) - circle_mask( shape, inner_radius, sigma )
+
+def broadcast( mask, img ):
+    '''Returns mask with a trailing axis added if needed, so that it multiplies against img'''
+    if mask.ndim == img.ndim - 1:
+        return mask[..., np.newaxis]
+    return mask
+
+def active_region( mask, hw, margin = 0 ):
+    '''Returns boolean array of height and width hw, True where mask (resized to hw) is over
+    active_threshold, or within margin pixels of such a point'''
+    if tuple( mask.shape[:2] ) != tuple( hw ):
+        mask = resample.resize( mask.reshape( mask.shape[:2] + (-1,) ), hw )
+    active = mask.reshape( mask.shape[:2] + (-1,) ).max( axis=2 ) > active_threshold
+    if margin > 0:
+        from scipy import ndimage
+        active = ndimage.maximum_filter( active, size = 2 * margin + 1 )
+    return active
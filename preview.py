@@ -0,0 +1,68 @@
+###############################################################################################
+#   Copyright 2016, Neil Slater.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+###############################################################################################
+
+# Preview scale for quick, low resolution renders of the whole animation. Scripts run with
+# --preview 0.25 (or with TFI_PREVIEW_SCALE set) load their input images at that scale, and
+# lengths given in full size pixels (margins, ring radii, mask blur) are scaled to match. Fewer
+# octaves are used, so that the coarsest octave is about the same size as at full scale. Output
+# goes to separate directories, so previews never mix with full renders
+
+import numpy as np
+import PIL.Image
+import math
+import os
+import sys
+
+def scale_from_args():
+    args = sys.argv[1:]
+    if '--preview' in args:
+        return float( args[ args.index( '--preview' ) + 1 ] )
+    return float( os.environ.get( 'TFI_PREVIEW_SCALE', 1.0 ) )
+
+scale = scale_from_args()
+
+def set_scale( new_scale ):
+    global scale
+    scale = float( new_scale )
+
+def scaled( length ):
+    '''Returns full size length in pixels, scaled for the preview'''
+    return length * scale
+
+def scaled_pixels( length ):
+    '''Returns full size length in pixels, scaled for the preview and rounded to a whole number'''
+    return max( 1, int( round( length * scale ) ) ) if length > 0 else 0
+
+def octaves( octave_n, octave_scale ):
+    '''Returns number of octaves to use in place of octave_n at full size'''
+    if scale >= 1.0:
+        return octave_n
+    dropped = int( round( math.log( 1.0 / scale ) / math.log( octave_scale ) ) )
+    return max( 1, octave_n - dropped )
+
+def output_dir( name ):
+    '''Returns name of output directory for the preview, e.g. animation_stage_01_x0.25'''
+    if scale == 1.0:
+        return name
+    return '{}_x{:g}'.format( name, scale )
+
+def load_image( filename ):
+    '''Returns image file as float32 array, resized for the preview'''
+    img = PIL.Image.open( filename )
+    if scale != 1.0:
+        width, height = img.size
+        img = img.resize( ( int( round( width * scale ) ), int( round( height * scale ) ) ), PIL.Image.LANCZOS )
+    return np.float32( img )
@@ -0,0 +1,207 @@
+###############################################################################################
+#   Copyright 2016, Neil Slater.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+###############################################################################################
+
+# Float32 bicubic resampling for HxWxC images, matching skimage.transform.warp with order=3 and
+# mode='reflect', but without float64 temporaries. Coordinate grids and resize weights depend
+# only on image shape, so they are cached and shared between frames. Gather positions and weights
+# for a zoom and rotation are cached too, as stages 2 and 3b and the merge warp every frame of long
+# runs by the same amounts
+
+import numpy as np
+import collections
+import math
+import threading
+
+grid_cache = {}
+resize_cache = {}
+
+# Number of warp plans kept, e.g. one per merge sweep. A full size plan takes about 85MB
+warp_cache = collections.OrderedDict()
+warp_cache_size = 2
+warp_cache_lock = threading.Lock()
+
+# Pixels sampled at a time, small enough that each block's samples stay in the CPU cache
+chunk_pixels = 16384
+
+def cubic_weights( t ):
+    '''Returns the four bicubic (Catmull-Rom) weights for samples at offsets -1, 0, 1 and 2 from
+    floor of each position, given fractional parts t'''
+    t2 = t * t
+    t3 = t2 * t
+    return ( 0.5 * ( 2 * t2 - t3 - t ),
+             0.5 * ( 3 * t3 - 5 * t2 + 2 ),
+             0.5 * ( 4 * t2 - 3 * t3 + t ),
+             0.5 * ( t3 - t2 ) )
+
+def reflect_index( idx, n ):
+    '''Maps integer positions into range 0 to n-1, mirroring about the edge pixels'''
+    if n == 1:
+        return np.zeros_like( idx )
+    period = 2 * ( n - 1 )
+    idx = np.abs( idx ) % period
+    return np.where( idx >= n, period - idx, idx )
+
+def centred_grid( shape ):
+    '''Returns row and column positions of every pixel relative to the image centre, as arrays
+    that broadcast to the image height and width'''
+    key = tuple( shape[:2] )
+    grid = grid_cache.get( key )
+    if grid is None:
+        height, width = key
+        rows = np.arange( height, dtype=np.float32 ) - np.float32( ( height - 1 ) / 2. )
+        cols = np.arange( width, dtype=np.float32 ) - np.float32( ( width - 1 ) / 2. )
+        grid = ( rows[:, np.newaxis], cols[np.newaxis, :] )
+        grid_cache[key] = grid
+    return grid
+
+def warp_plan( shape, src_rows, src_cols ):
+    '''Returns (pad, base, weights) for sampling images of shape at the float32 positions
+    src_rows and src_cols. The image is mirrored out by pad pixels, base holds the flat index of
+    the top-left sample of each 4x4 block in the padded image, and weights holds the 16 bicubic
+    weights of each block, one row per sample'''
+    height, width = shape[:2]
+    out_shape = np.broadcast( src_rows, src_cols ).shape
+    src_rows = np.broadcast_to( src_rows, out_shape ).ravel()
+    src_cols = np.broadcast_to( src_cols, out_shape ).ravel()
+    r0 = np.floor( src_rows )
+    c0 = np.floor( src_cols )
+
+    # Mirror the image out far enough that all 16 samples for every position fall inside it.
+    # Each sample is then a lookup at a fixed offset from the top-left sample of the 4x4 block
+    pad = int( max( 2, 1 - min( r0.min(), c0.min() ), r0.max() + 3 - height, c0.max() + 3 - width ) )
+    padded_width = width + 2 * pad
+
+    size = src_rows.size
+    base = np.empty( size, dtype=np.intp )
+    weights = np.empty( ( 16, size ), dtype=np.float32 )
+    for start in range( 0, size, chunk_pixels ):
+        block = slice( start, start + chunk_pixels )
+        row_weights = cubic_weights( src_rows[block] - r0[block] )
+        col_weights = cubic_weights( src_cols[block] - c0[block] )
+        for i in range(4):
+            for j in range(4):
+                np.multiply( row_weights[i], col_weights[j], out=weights[i * 4 + j, block] )
+        base[block] = ( ( r0[block].astype( np.intp ) + pad - 1 ) * padded_width +
+                        c0[block].astype( np.intp ) + pad - 1 )
+    return pad, base, weights
+
+def warp_with_plan( img, plan, out_shape, out = None ):
+    '''Returns image of height and width out_shape sampled from img as set out by plan, from
+    warp_plan. Written into out if supplied'''
+    pad, base, weights = plan
+    height, width, ch = img.shape
+    padded_width = width + 2 * pad
+    offsets = [ i * padded_width + j for i in range(4) for j in range(4) ]
+    planes = np.pad( img.astype( np.float32, copy=False ).transpose(2, 0, 1),
+                     ( (0, 0), (pad, pad), (pad, pad) ), mode='reflect' ).reshape( ch, -1 )
+
+    planar_out = np.empty( ( ch, base.size ), dtype=np.float32 )
+    sample = np.empty( chunk_pixels, dtype=np.float32 )
+    for start in range( 0, base.size, chunk_pixels ):
+        block = slice( start, start + chunk_pixels )
+        block_base = base[block]
+        block_sample = sample[:block_base.size]
+        for c in range(ch):
+            block_out = planar_out[c, block]
+            for k, offset in enumerate( offsets ):
+                np.take( planes[c, offset:], block_base, out=block_sample )
+                block_sample *= weights[k, block]
+                if k == 0:
+                    block_out[...] = block_sample
+                else:
+                    block_out += block_sample
+
+    planar_out = planar_out.reshape( ( ch, ) + tuple( out_shape ) ).transpose(1, 2, 0)
+    if out is None:
+        return np.ascontiguousarray( planar_out )
+    out[...] = planar_out
+    return out
+
+def warp_coords( img, src_rows, src_cols, out = None ):
+    '''Returns image sampled from img at the float32 positions src_rows and src_cols, using
+    bicubic interpolation and reflect boundaries. Written into out if supplied'''
+    out_shape = np.broadcast( src_rows, src_cols ).shape
+    return warp_with_plan( img, warp_plan( img.shape, src_rows, src_cols ), out_shape, out )
+
+def affine_plan( shape, zoom, spin ):
+    '''Returns warp plan for a central-origin zoom and rotation of images of shape, from the
+    cache if the same zoom and rotation was used recently'''
+    key = ( tuple( shape[:2] ), float( zoom ), float( spin ) )
+    with warp_cache_lock:
+        plan = warp_cache.get( key )
+        if plan is not None:
+            warp_cache.move_to_end( key )
+            return plan
+
+    rows, cols = centred_grid( shape )
+    height, width = shape[:2]
+    angle = spin * math.pi/180
+    cos_a = np.float32( math.cos( angle ) / zoom )
+    sin_a = np.float32( math.sin( angle ) / zoom )
+
+    # Inverse map from each output pixel back to its source position
+    src_cols = cos_a * cols + sin_a * rows + np.float32( ( width - 1 ) / 2. )
+    src_rows = cos_a * rows - sin_a * cols + np.float32( ( height - 1 ) / 2. )
+    plan = warp_plan( shape, src_rows, src_cols )
+    with warp_cache_lock:
+        warp_cache[key] = plan
+        while len( warp_cache ) > warp_cache_size:
+            warp_cache.popitem( last=False )
+    return plan
+
+def affine_zoom( img, zoom, spin = 0, out = None ):
+    '''Returns new image derived from img, after a central-origin zoom and rotation (spin in
+    degrees) has been applied. Written into out if supplied, which must not be img'''
+    return warp_with_plan( img, affine_plan( img.shape, zoom, spin ), img.shape[:2], out )
+
+def resize_weights( n_in, n_out ):
+    '''Returns cached source indices and bicubic weights for resizing one axis from n_in to
+    n_out pixels, with pixel centres aligned as in skimage.transform.resize'''
+    key = ( n_in, n_out )
+    cached = resize_cache.get( key )
+    if cached is None:
+        scale = n_in / float( n_out )
+        src = ( ( np.arange( n_out, dtype=np.float32 ) + np.float32(0.5) ) * np.float32( scale )
+                - np.float32(0.5) )
+        i0 = np.floor( src )
+        weights = cubic_weights( src - i0 )
+        i0 = i0.astype( np.intp )
+        indices = [ reflect_index( i0 + i - 1, n_in ) for i in range(4) ]
+        cached = ( indices, weights )
+        resize_cache[key] = cached
+    return cached
+
+def resize( img, hw ):
+    '''Returns float32 bicubic resize of img to height and width in hw, done one axis at a time'''
+    height, width, ch = img.shape
+    out_height, out_width = int( hw[0] ), int( hw[1] )
+
+    indices, weights = resize_weights( height, out_height )
+    by_rows = np.zeros( ( out_height, width, ch ), dtype=np.float32 )
+    sample = np.empty_like( by_rows )
+    for i in range(4):
+        np.take( img, indices[i], axis=0, out=sample )
+        sample *= weights[i][:, np.newaxis, np.newaxis]
+        by_rows += sample
+
+    indices, weights = resize_weights( width, out_width )
+    out = np.zeros( ( out_height, out_width, ch ), dtype=np.float32 )
+    sample = np.empty_like( out )
+    for i in range(4):
+        np.take( by_rows, indices[i], axis=1, out=sample )
+        sample *= weights[i][np.newaxis, :, np.newaxis]
+        out += sample
+    return out
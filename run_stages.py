@@ -0,0 +1,245 @@
+###############################################################################################
+#   Copyright 2016, Neil Slater.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+###############################################################################################
+
+# Script runs the animation stages at the same time instead of one after another. Stages 1, 2 and
+# 3 all start from the same start frame and do not depend on each other, so each is run as its own
+# process, pinned to a share of the CPU cores sized to its amount of rendering, with TensorFlow
+# thread counts to match. The merge stage needs the overlap frames of stages 1 and 2, so it is
+# started once both have finished, on the cores they were using. Output of each script goes to
+# run.log in its directory, and progress is printed every poll_seconds. Any other arguments, e.g.
+# --resume or --preview 0.25, are passed on to every script
+
+import framestore
+import preview
+import schedule
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+poll_seconds = 60
+inter_op_threads = 2
+
+# Script, output directory, the schedule sections it renders, and for each of its checkpoints
+# the progress file name and checkpoint sections as ( name, first step, number of steps )
+merge_sweep_frames = schedule.merge_end_frame - schedule.merge_start_frame
+stages = {
+    '01': ( 'animation_stage_01.py', 'animation_stage_01', ( '01', '01_overlap' ), {
+        'progress.json': [ ( 'main', 0, schedule.stage_01_frames ),
+                           ( 'overlap', schedule.stage_01_frames, schedule.overlap_frames ) ] } ),
+    '02': ( 'animation_stage_02.py', 'animation_stage_02', ( '02', ), {
+        'progress.json': [ ( 'frames', 0, schedule.stage_02_end_frame - schedule.stage_02_start_frame - 1 ) ] } ),
+    '03': ( 'animation_stage_03.py', 'animation_stage_03', ( '03a', '03b' ), {
+        'progress.json': [ ( '3a', schedule.stage_03a_start_frame, schedule.stage_03a_end_frame - schedule.stage_03a_start_frame ),
+                           ( '3b', schedule.stage_03b_start_frame, schedule.stage_03b_end_frame - schedule.stage_03b_start_frame ) ] } ),
+    # The merge runs its forward and back sweeps at the same time, each with its own checkpoint
+    'merge': ( 'animation_merge_stage.py', 'animation_merges', ( 'merge', ), {
+        'progress_{}.json'.format( direction ): [ ( '{}_{}'.format( direction, pct ), 0, merge_sweep_frames )
+                                                 for pct in schedule.merge_end_percents[1:] ]
+        for direction in ( 'fwd', 'back' ) } ),
+}
+
+# Stages that must finish before the merge can start
+merge_needs = [ '01', '02' ]
+
+def stage_work( name ):
+    '''Rough amount of rendering in a stage, as the number of gradient iterations in its schedule'''
+    rows = schedule.table( *stages[name][2] )
+    return int( rows['iter_n'][ rows['objective'] >= 0 ].sum() )
+
+def partition_cores( cores, weights ):
+    '''Splits list of cores into consecutive runs, one per weight, sized in proportion to the
+    weights, with at least one core each'''
+    total = float( sum( weights ) )
+    counts = [ max( 1, int( len( cores ) * w / total ) ) for w in weights ]
+    # Spare cores go to the largest shares first
+    by_share = sorted( range( len( weights ) ), key = lambda i: -weights[i] )
+    i = 0
+    while sum( counts ) < len( cores ):
+        counts[ by_share[ i % len( counts ) ] ] += 1
+        i += 1
+    while sum( counts ) > len( cores ) and max( counts ) > 1:
+        counts[ counts.index( max( counts ) ) ] -= 1
+    parts = []
+    start = 0
+    for n in counts:
+        parts.append( cores[start:start + n] or cores[-1:] )
+        start += n
+    return parts
+
+def progress( name ):
+    '''Returns number of frames a stage has completed, from the progress files its checkpoints write'''
+    total = 0
+    for progress_file, sections in stages[name][3].items():
+        try:
+            with open( os.path.join( preview.output_dir( stages[name][1] ), progress_file ) ) as f:
+                position = json.load( f )
+        except ( IOError, OSError, ValueError ):
+            continue
+        done = 0
+        for section, first, n in sections:
+            if section == position['section']:
+                total += done + position['step'] - first + 1
+                break
+            done += n
+    return total
+
+def total_frames( name ):
+    return sum( n for sections in stages[name][3].values() for section, first, n in sections )
+
+def missing_overlap_frames():
+    '''Returns number of stage 1 and 2 overlap frames that the merge needs but cannot find, either
+    in the state store or as overlap JPEGs'''
+    store = framestore.FrameStore( preview.output_dir( framestore.state_dir ) )
+    needed = [ ( 'fwd', 'animation_stage_01', fno )
+               for fno in range( schedule.merge_start_frame, schedule.merge_end_frame + 1 ) ]
+    needed += [ ( 'back', 'animation_stage_02', fno )
+                for fno in range( schedule.merge_start_frame + 1, schedule.merge_end_frame + 2 ) ]
+    missing = 0
+    for direction, directory, fno in needed:
+        jpeg = '{}/overlap_frame_{}.jpeg'.format( preview.output_dir( directory ), '%04d' % fno )
+        if not ( store.has( direction, 100, fno ) or os.path.isfile( jpeg ) ):
+            missing += 1
+    return missing
+
+def start( name, cores, script_args ):
+    '''Starts stage script pinned to cores, with TensorFlow and numpy thread counts set to match.
+    Returns the process'''
+    script, directory = stages[name][:2]
+    directory = preview.output_dir( directory )
+    if not os.path.exists( directory ):
+        os.makedirs( directory )
+    if '--resume' not in script_args:
+        # A progress file left from an earlier run would be read as this run's progress
+        for progress_file in stages[name][3]:
+            if os.path.isfile( os.path.join( directory, progress_file ) ):
+                os.remove( os.path.join( directory, progress_file ) )
+
+    env = dict( os.environ )
+    env['TFI_INTRA_OP_THREADS'] = str( len( cores ) )
+    env['TFI_INTER_OP_THREADS'] = str( inter_op_threads )
+    env['OMP_NUM_THREADS'] = str( len( cores ) )
+    env['MKL_NUM_THREADS'] = str( len( cores ) )
+
+    def pin():
+        if hasattr( os, 'sched_setaffinity' ):
+            os.sched_setaffinity( 0, cores )
+
+    print( 'Starting {} on cores {}-{}'.format( script, cores[0], cores[-1] ) )
+    log = open( os.path.join( directory, 'run.log' ), 'a' )
+    process = subprocess.Popen( [ sys.executable, script ] + script_args, stdout = log,
+                                stderr = subprocess.STDOUT, env = env, preexec_fn = pin )
+    log.close()
+    return process
+
+def format_hours( seconds ):
+    return '{:.0f}h{:02.0f}m'.format( seconds // 3600, ( seconds % 3600 ) // 60 )
+
+parser = argparse.ArgumentParser( description = 'Render animation stages in parallel, then the merge' )
+parser.add_argument( '--stages', nargs = '+', default = [ '01', '02', '03', 'merge' ],
+                     choices = sorted( stages ), help = 'stages to run (default all)' )
+parser.add_argument( '--cores', type = int, help = 'number of cores to use (default all available)' )
+args, script_args = parser.parse_known_args()
+
+if hasattr( os, 'sched_getaffinity' ):
+    all_cores = sorted( os.sched_getaffinity(0) )
+else:
+    print( 'Warning: cannot pin processes to cores on this system, only thread counts are set' )
+    all_cores = list( range( os.cpu_count() ) )
+if args.cores:
+    all_cores = all_cores[:args.cores]
+
+independent = [ name for name in args.stages if name != 'merge' ]
+run_merge = 'merge' in args.stages
+if not independent and not run_merge:
+    sys.exit( 0 )
+
+processes = {}
+stage_cores = {}
+started = {}
+first_done = {}
+if independent:
+    parts = partition_cores( all_cores, [ stage_work( name ) for name in independent ] )
+    for name, cores in zip( independent, parts ):
+        stage_cores[name] = cores
+        first_done[name] = progress( name ) if '--resume' in script_args else 0
+        started[name] = time.time()
+        processes[name] = start( name, cores, script_args )
+
+failed = []
+try:
+    while True:
+        finished = { name: p.returncode for name, p in processes.items() if p.poll() is not None }
+        for name, code in finished.items():
+            if code != 0 and name not in failed:
+                print( 'Stage {} failed with exit code {}, see {}/run.log'.format(
+                    name, code, preview.output_dir( stages[name][1] ) ) )
+                failed.append( name )
+
+        # Merge starts on every free core, once the stages it reads from are done
+        if run_merge and 'merge' not in processes:
+            waiting = [ name for name in merge_needs if name in processes and name not in finished ]
+            if any( name in failed for name in merge_needs ):
+                print( 'Not running merge, as a stage it needs failed' )
+                run_merge = False
+            elif not waiting:
+                missing = missing_overlap_frames()
+                if missing:
+                    print( 'Not running merge, {} overlap frames from stages 1 and 2 are missing'.format( missing ) )
+                    run_merge = False
+                    failed.append( 'merge' )
+                else:
+                    busy = set( core for name, cores in stage_cores.items() if name not in finished for core in cores )
+                    cores = [ core for core in all_cores if core not in busy ] or all_cores
+                    stage_cores['merge'] = cores
+                    first_done['merge'] = progress( 'merge' ) if '--resume' in script_args else 0
+                    started['merge'] = time.time()
+                    processes['merge'] = start( 'merge', cores, script_args )
+                    continue
+
+        if all( p.poll() is not None for p in processes.values() ) and not ( run_merge and 'merge' not in processes ):
+            break
+
+        # Estimates are from this run's rate for each stage, so they settle after a few frames
+        lines = []
+        for name, p in sorted( processes.items() ):
+            done = progress( name )
+            total = total_frames( name )
+            if p.poll() is not None:
+                state = 'finished' if p.returncode == 0 else 'failed'
+            elif done > first_done[name]:
+                rate = ( time.time() - started[name] ) / ( done - first_done[name] )
+                state = 'about {} left'.format( format_hours( rate * ( total - done ) ) )
+            else:
+                state = 'starting'
+            lines.append( '{} {}/{} ({})'.format( name, done, total, state ) )
+        print( '{} | {}'.format( time.strftime( '%H:%M' ), ', '.join( lines ) ) )
+        sys.stdout.flush()
+        time.sleep( poll_seconds )
+except KeyboardInterrupt:
+    print( 'Stopping stages. Run again with --resume to continue from their checkpoints' )
+    for p in processes.values():
+        if p.poll() is None:
+            p.terminate()
+    for p in processes.values():
+        p.wait()
+    sys.exit( 1 )
+
+if failed:
+    sys.exit( 1 )
+print( 'All stages finished' )
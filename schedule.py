@@ -0,0 +1,518 @@
+###############################################################################################
+#   Copyright 2016, Neil Slater.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+###############################################################################################
+
+# Per-frame parameters for the whole animation, frames 0 to 5445, worked out up front instead of
+# inside each stage loop. Every rendered frame gets one row of a numpy table, in the order the
+# frames are rendered, holding its objective, renderer, step size, zoom and rotation, ring and
+# clearing circle positions and mix ratios. Objectives are numbered, so that tfi.Engine.prepare
+# can build and warm each distinct gradient op once before a stage starts. This module only does
+# arithmetic, and does not need TensorFlow
+
+import numpy as np
+import math
+import os
+
+octave_n = 4
+octave_scale = 1.5
+
+# Stage 1, frames 0 to 960, plus 240 overlap frames for merging with stage 2
+stage_01_targets = [
+    'mixed4b_3x3_bottleneck_pre_relu', 105, # girders
+
+    'mixed4a_3x3_bottleneck_pre_relu', 8, # molten glass
+
+    'mixed4a_3x3_bottleneck_pre_relu', 24, # leopard spots
+
+    'mixed3b_3x3_pre_relu', 22, # Glowing croc skin
+
+    'mixed4a_3x3_bottleneck_pre_relu', 83, # paisley
+
+    'mixed4a_3x3_bottleneck_pre_relu', 73, # ball bearings
+
+    'mixed4b_3x3_bottleneck_pre_relu', 68, # fur
+
+    'mixed5a_3x3_bottleneck_pre_relu', 3, # Lattice with gems
+
+    'mixed5a_3x3_bottleneck_pre_relu', 3, # Lattice with gems
+    'mixed5a_3x3_bottleneck_pre_relu', 3, # Lattice with gems
+]
+
+stage_size = 240
+num_stages = 4
+stage_01_frames = stage_size * num_stages
+overlap_frames = 240
+transition_start = 930
+transition_zoom = 0.997
+transition_rot = 0.2
+
+# Lattice with gems, which is what we expect to merge with in stage 2
+overlap_target = ( 'mixed5a_3x3_bottleneck_pre_relu', 3 )
+
+# Stage 2, rendered backwards from frame 4800 to 961. Each entry corresponds to 240 frames = 8
+# seconds of video
+stage_02_targets = [
+    # Previous
+    'mixed5a_3x3_bottleneck_pre_relu', 3, # Lattice with gems ++
+    'mixed5a_3x3_bottleneck_pre_relu', 3, # Lattice with gems ++
+    'mixed5a_3x3_bottleneck_pre_relu', 3, # Lattice with gems ++
+    'mixed5a_3x3_bottleneck_pre_relu', 3, # Lattice with gems ++
+
+    # Quieter bit
+    'mixed5a_3x3_bottleneck_pre_relu', 3, # Lattice with gems ++
+    'head1_bottleneck_pre_relu', 62, # Ocean pattern ++
+    'head0_bottleneck_pre_relu', 116, # Pointy ++
+    'mixed4b_3x3_bottleneck_pre_relu', 28, # fuzzy links ++
+
+    # Added bass drums
+    'head0_bottleneck_pre_relu', 3, # Harbour/islands ++
+    'head0_bottleneck_pre_relu', 16, # Baubles ++
+    'head0_bottleneck_pre_relu', 22, # Arches ++
+    'head0_bottleneck_pre_relu', 67, # Crystal wings ++
+
+    # Louder bit
+    'head0_bottleneck_pre_relu', 84, # Garden ruins
+    'mixed4b_3x3_bottleneck_pre_relu', 110, # patterned ++
+    'mixed5a_3x3_bottleneck_pre_relu', 76, # structured swirls ++
+    'head0_bottleneck_pre_relu', 0, # Domed buildings ++
+
+    'head0_bottleneck_pre_relu', 114, # Tiger ++
+    'head0_bottleneck_pre_relu', 124, # Glowing doors ++
+    'mixed4b_3x3_bottleneck_pre_relu', 111, # geigery ++
+    'mixed4b_3x3_bottleneck_pre_relu', 111, # geigery ++
+
+    # Spares
+    'head1_bottleneck_pre_relu', 64, # Birds
+    'mixed3a_3x3_pre_relu', 9999, # tf.square( all )
+    'mixed4a_3x3_bottleneck_pre_relu', 42, # worms
+    'mixed4b_3x3_bottleneck_pre_relu', 68, # fur
+    'head0_bottleneck_pre_relu', 18, # Trumpets
+    'head0_bottleneck_pre_relu', 23, # Eye waves?
+    'head0_bottleneck_pre_relu', 26, # Network
+    'head0_bottleneck_pre_relu', 47, # Pyramids
+    'head0_bottleneck_pre_relu', 53, # Feathers
+    'head0_bottleneck_pre_relu', 127, # Bead circles
+    'head0_bottleneck_pre_relu', 120, # Snakes
+    'head0_bottleneck_pre_relu', 116, # Pointy
+    'head1_bottleneck_pre_relu', 45, # Odd machinery
+    'head1_bottleneck_pre_relu', 59, # Ocean pattern
+    'head1_bottleneck_pre_relu', 65, # Turtles
+    'head1_bottleneck_pre_relu', 93, # Little buildings
+    'head1_bottleneck_pre_relu', 108, # Firey patches
+    'head1_bottleneck_pre_relu', 125, # Appliances
+]
+
+channel_step = 240 # 16 targets
+stage_02_start_frame = 960
+stage_02_end_frame = 4800
+slow_zoom = 1.0/0.997
+slow_rot = 0.2
+fast_zoom = 1.0/0.994
+fast_rot = 0.35
+
+# Stage 3, frames 4800 to 5040 with texture rings, then 5040 to 5445 zooming in to the credits
+stage_03_targets = [
+    'head0_bottleneck_pre_relu', 53, # Feathers
+    'mixed5a_3x3_bottleneck_pre_relu', 11, # Dog face and circles
+    'mixed5a_3x3_bottleneck_pre_relu', 119, # Butterfly
+    'mixed5a_3x3_bottleneck_pre_relu', 33, # Spider monkey brains
+    'head0_bottleneck_pre_relu', 18, # Trumpets
+    'head0_bottleneck_pre_relu', 23, # Eye waves
+    'head0_bottleneck_pre_relu', 26, # Network
+    'head0_bottleneck_pre_relu', 47, # Pyramids
+    'head0_bottleneck_pre_relu', 127, # Bead circles
+    'head0_bottleneck_pre_relu', 124, # Glowing doors
+    'head0_bottleneck_pre_relu', 120, # Snakes
+    'head0_bottleneck_pre_relu', 116, # Pointy
+    'head1_bottleneck_pre_relu', 45, # Odd machinery
+    'head1_bottleneck_pre_relu', 59, # Ocean pattern
+    'head1_bottleneck_pre_relu', 65, # Turtles
+    'head1_bottleneck_pre_relu', 93, # Little buildings
+    'head1_bottleneck_pre_relu', 108, # Firey patches
+    'head1_bottleneck_pre_relu', 125, # Appliances
+    'mixed4b_3x3_bottleneck_pre_relu', 105, # girders
+    'mixed3a_3x3_pre_relu', 54, # swirls
+    'head0_bottleneck_pre_relu', 79, # Animal stripes
+    'mixed4a_3x3_bottleneck_pre_relu', 2, # x hashing
+    'mixed4a_3x3_bottleneck_pre_relu', 14, # windows
+    'head0_bottleneck_pre_relu', 84, # Garden ruins
+]
+
+stage_03a_start_frame = 4800
+stage_03a_end_frame = 5040
+stage_03b_start_frame = 5040
+stage_03b_end_frame = 5445
+
+# Merge of the stage 1 and stage 2 overlap, run forwards then backwards once per end percentage
+merge_start_frame = 960
+merge_end_frame = 1190
+merge_end_percents = [100, 98, 96, 92, 84, 68, 50, 0]
+merge_target = ( 'mixed5a_3x3_bottleneck_pre_relu', 3 )
+fwd_zoom = 0.997
+fwd_rot = 0.2
+back_zoom = 1.0/0.997
+back_rot = -0.2
+
+# Texture rings and clearing circles of stages 1 and 3a. These control start times of circle
+# effects, number of frames offset within each stage_size. There are 45 ring images, expanding
+# from the centre to the outer edge
+ring_stages = 45
+first_ring_offset_a = 30
+second_ring_offset_a = 45
+clear_offset_a = 60
+
+first_ring_offset_b = 120
+second_ring_offset_b = 135
+clear_offset_b = 150
+
+# Clearing circles, in the order they are applied to a frame, and after ring_stages the whole
+# frame is mixed for this many more frames
+clear_offsets = [ second_ring_offset_a, clear_offset_a, second_ring_offset_b, clear_offset_b ]
+clear_weights = [ 0.05, 0.1, 0.05, 0.1 ]
+clear_tail = 4
+
+# Stage 1 continues without clearing away debris from this frame on
+stage_01_clear_b_end = 850
+
+sections = [ '01', '01_overlap', '02', '03a', '03b', 'merge_fwd', 'merge_back' ]
+renderers = [ 'tiled', 'ring', 'in_graph' ]
+
+# Stages 2 and 3b can render each frame in one TensorFlow call with Engine.render_grad_in_graph.
+# It takes gradients over the whole frame instead of random-shifted tiles, and resizes octaves in
+# TensorFlow, so it does not give the same frames as the tiled renderer. It is only used for the
+# sections listed in TFI_IN_GRAPH, e.g. TFI_IN_GRAPH=02,03b. See benchmark_in_graph.py
+in_graph_sections = [ name for name in os.environ.get( 'TFI_IN_GRAPH', '' ).split( ',' ) if name ]
+
+def plain_renderer( section ):
+    '''Returns renderers index for frames of section rendered without texture rings'''
+    return renderers.index( 'in_graph' if section in in_graph_sections else 'tiled' )
+
+frame_dtype = np.dtype( [
+    ( 'section', np.uint8 ),      # index in sections
+    ( 'fno', np.int16 ),
+    ( 'objective', np.int16 ),    # index in objectives, or -1 for no render
+    ( 'channel_1', np.int16 ),    # channels and fraction of the second, for blend objectives
+    ( 'channel_2', np.int16 ),
+    ( 'blend', np.float64 ),
+    ( 'renderer', np.uint8 ),     # index in renderers
+    ( 'iter_n', np.uint8 ),
+    ( 'step', np.float64 ),
+    ( 'delta_zoom', np.float64 ),
+    ( 'delta_rot', np.float64 ),
+    ( 'ring', np.int16 ),         # texture ring image, or -1
+    ( 'clear', np.int16, 4 ),     # step of each clearing circle in clear_offsets, or -1
+    ( 'mix', np.float64 ),        # ratio kept when mixing in the section's guide image
+    ( 'guide', np.int16 ),        # stage 2 colour guide
+    ( 'fade', np.float64 ),       # stage 3b fade to black and credits, 1.0 for none
+    ( 'credits', np.float64 ),
+    ( 'pct', np.int16 ),          # merge pass end percentage, and the one before it
+    ( 'prev_pct', np.int16 ),
+] )
+
+# Objective keys, as used by tfi.Engine.cached_grad: (layer, channel, kind) for objective_grad,
+# or (layer_1, layer_2, 'blend') for blend_grad. Rows refer to them by index
+objectives = []
+
+def objective_id( key ):
+    '''Returns index of objective key, adding it to objectives if it is new'''
+    if key not in objectives:
+        objectives.append( key )
+    return objectives.index( key )
+
+def new_rows( section, fnos ):
+    '''Returns table rows for frame numbers fnos of section, with nothing rendered or mixed'''
+    rows = np.zeros( len( fnos ), dtype = frame_dtype )
+    rows['section'] = sections.index( section )
+    rows['fno'] = fnos
+    rows['objective'] = -1
+    rows['channel_1'] = -1
+    rows['channel_2'] = -1
+    rows['iter_n'] = 1
+    rows['step'] = 1.5
+    rows['delta_zoom'] = 1.0
+    rows['ring'] = -1
+    rows['clear'] = -1
+    rows['mix'] = 1.0
+    rows['fade'] = 1.0
+    rows['credits'] = 1.0
+    return rows
+
+def set_objective( row, layer, channel ):
+    row['objective'] = objective_id( ( layer, channel, 'mean' ) )
+
+def set_blend( row, layer_1, channel_1, layer_2, channel_2, r ):
+    row['objective'] = objective_id( ( layer_1, layer_2, 'blend' ) )
+    row['channel_1'] = channel_1
+    row['channel_2'] = channel_2
+    row['blend'] = r
+
+def set_rings( row, pattern_step, targets_a, targets_b, clear_b = True ):
+    '''Sets texture ring and clearing circles for pattern_step of a stage 1 or 3a section. The
+    a and b rings use (layer, channel) of targets_a and targets_b'''
+    for offset, target in ( ( first_ring_offset_a, targets_a ), ( first_ring_offset_b, targets_b ) ):
+        if pattern_step >= offset and pattern_step < offset + ring_stages:
+            set_objective( row, *target )
+            row['renderer'] = renderers.index( 'ring' )
+            row['iter_n'] = 3
+            row['ring'] = pattern_step - offset
+    for i, offset in enumerate( clear_offsets ):
+        if i >= 2 and not clear_b:
+            continue
+        if pattern_step >= offset and pattern_step < offset + ring_stages + clear_tail:
+            row['clear'][i] = pattern_step - offset
+
+def stage_01_rows():
+    rows = new_rows( '01', range( 1, stage_01_frames + 1 ) )
+    for row in rows:
+        fno = int( row['fno'] )
+        section_id = ( fno // ( stage_size // 2 ) )
+        target = ( stage_01_targets[ section_id * 2 ], stage_01_targets[ section_id * 2 + 1 ] )
+        pattern_step = fno % stage_size
+
+        delta_rot = ( 0.02 + section_id * 0.0025 ) * ( 0.5 * math.sin( fno / 23.0 ) + math.sin( fno / 37.0 ) )
+        delta_zoom = 1.0 - ( 0.0002 + section_id * 0.000025 ) *  ( 0.5 * math.sin( fno / 17.0 ) + math.sin( fno / 26.0 ) )
+
+        if fno > transition_start:
+            rat = (960 - fno)/float(960-transition_start)
+            delta_rot = rat * delta_rot  + (1-rat) * transition_rot
+            delta_zoom = rat * delta_zoom  + (1-rat) * transition_zoom
+
+        row['delta_rot'] = delta_rot
+        row['delta_zoom'] = delta_zoom
+        set_rings( row, pattern_step, target, target, clear_b = fno < stage_01_clear_b_end )
+    return rows
+
+def stage_01_overlap_rows():
+    frames = stage_01_frames
+    rows = new_rows( '01_overlap', range( frames + 1, frames + overlap_frames + 1 ) )
+    section_id = 7
+    layer_1 = stage_01_targets[ section_id  * 2 + 2]
+    channel_1 = stage_01_targets[ section_id * 2 + 3]
+    layer_2, channel_2 = overlap_target
+    for row in rows:
+        fno = int( row['fno'] )
+        if ( fno % 240 ) < 120:
+            set_blend( row, layer_1, channel_1, layer_2, channel_2, (fno - frames)/120.0 )
+        else:
+            set_objective( row, layer_2, channel_2 )
+
+        delta_rot = transition_rot
+        if ( fno % 240 ) > 230:
+            delta_rot *= ( 240 - ( fno % 240 ) ) / 10.0
+        if fno > 980 and ( fno % 240 ) < 10:
+            delta_rot *= ( fno % 240 ) / 10.0
+
+        row['delta_rot'] = delta_rot
+        row['delta_zoom'] = transition_zoom
+    return rows
+
+def stage_02_rows():
+    # We don't produce actual frame 960 in the overlap section
+    rows = new_rows( '02', range( stage_02_end_frame - 1, stage_02_start_frame, -1 ) )
+    targets = stage_02_targets
+    rows['renderer'] = plain_renderer( '02' )
+    rows['mix'] = 0.997
+    for row in rows:
+        fno = int( row['fno'] )
+        section_id = ( fno // channel_step )
+        prev_layer = targets[ (section_id-1)  * 2 ]
+        prev_channel = targets[ (section_id-1) * 2 + 1]
+        layer = targets[ section_id  * 2 ]
+        channel = targets[ section_id * 2 + 1]
+
+        # Mixed target for first half of each channel_step
+        if ( fno % 240 ) < 120:
+            set_blend( row, prev_layer, prev_channel, layer, channel, (fno % 240)/120.0 )
+        else:
+            set_objective( row, layer, channel )
+
+        rot = slow_rot
+        zoom = slow_zoom
+
+        # We start with section 4
+        if section_id >= 8:
+            rot = fast_rot
+            zoom = fast_zoom
+        elif section_id == 7:
+            rot = 0.75 * fast_rot + 0.25 * slow_rot
+            zoom = 0.75 * fast_zoom + 0.25 * slow_zoom
+        elif section_id == 6:
+            rot = 0.5 * fast_rot + 0.5 * slow_rot
+            zoom = 0.5 * fast_zoom + 0.5 * slow_zoom
+        elif section_id == 5:
+            rot = 0.25 * fast_rot + 0.75 * slow_rot
+            zoom = 0.25 * fast_zoom + 0.75 * slow_zoom
+
+        # This should line up with 960 being reverse of same thing in stage_01, which we want!
+        if ( fno % 480 ) < 240:
+            rot = -rot
+
+        if ( fno > 970 ):
+            if ( fno % 240 ) < 10:
+                rot *= ( fno % 240 )/10.0
+
+            if ( fno % 240 ) > 230:
+                rot *= ( 240 - ( fno % 240 ) ) / 10.0
+
+        step_val = 1.25
+        if (fno > 4600):
+            step_val = 0.5 + 0.75 * (4800 - fno)/200.0
+
+        row['delta_rot'] = rot
+        row['delta_zoom'] = zoom
+        row['step'] = step_val
+        row['guide'] = section_id % 4
+    return rows
+
+def stage_03a_rows():
+    rows = new_rows( '03a', range( stage_03a_start_frame + 1, stage_03a_end_frame + 1 ) )
+    target_1 = tuple( stage_03_targets[0:2] )
+    target_2 = tuple( stage_03_targets[2:4] )
+    for row in rows:
+        fno = int( row['fno'] )
+        pattern_step = fno % 240
+        row['delta_rot'] = ( 0.04 ) * ( 0.5 * math.sin( pattern_step / 21.0 ) + math.sin( pattern_step / 35.0 ) )
+        row['delta_zoom'] = 1.0 - ( 0.0003 ) *  ( 0.5 * math.sin( pattern_step / 15.0 ) + math.sin( pattern_step / 23.0 ) )
+        set_rings( row, pattern_step, target_1, target_2 )
+    return rows
+
+def stage_03b_rows():
+    start_frame = stage_03b_start_frame
+    end_frame = stage_03b_end_frame
+    rows = new_rows( '03b', range( start_frame + 1, end_frame + 1 ) )
+    rows['renderer'] = plain_renderer( '03b' )
+    rows['iter_n'] = 2
+    rows['delta_rot'] = 0.1
+    rows['delta_zoom'] = 1.05
+    for row in rows:
+        fno = int( row['fno'] )
+        section_id = ( (fno - start_frame) // 30 ) + 2
+        set_objective( row, stage_03_targets[ section_id * 2 ], stage_03_targets[ section_id * 2 + 1 ] )
+
+        r = (fno - start_frame)/(end_frame - start_frame)
+        row['mix'] = 0.99 * (1-r) + 0.96 * r
+
+        # Fade to black, then fade in credits
+        if (fno > 5400):
+            row['fade'] = 1.0 - (fno - 5400)/45.0
+        if (fno > 5430):
+            row['credits'] = 1.0 - (fno - 5430)/15.0
+    return rows
+
+def merge_rows():
+    '''Returns rows for every merge pass, forward then back for each end percentage in turn'''
+    start_frame = merge_start_frame
+    end_frame = merge_end_frame
+    passes = []
+    for merge_end_id in range( len(merge_end_percents) -1 ):
+        prev_end_pct = merge_end_percents[merge_end_id]
+        this_end_pct = merge_end_percents[merge_end_id+1]
+        end_ratio = this_end_pct/100.0
+        start_ratio = 1.0 - 0.01 * (1.0 - end_ratio) # Varies from 1.0 to 0.99
+
+        for direction, fnos in ( ( 'fwd', range( start_frame + 1, end_frame + 1 ) ),
+                                 ( 'back', range( end_frame, start_frame, -1 ) ) ):
+            rows = new_rows( 'merge_' + direction, fnos )
+            set_objective( rows, *merge_target )
+            rows['iter_n'] = 2
+            rows['pct'] = this_end_pct
+            rows['prev_pct'] = prev_end_pct
+            if direction == 'fwd':
+                rows['delta_zoom'] = fwd_zoom
+                rows['delta_rot'] = fwd_rot
+            else:
+                rows['delta_zoom'] = back_zoom
+                rows['delta_rot'] = back_rot
+            for row in rows:
+                r = ( (int( row['fno'] ) - start_frame)/float(end_frame-start_frame) )
+                if direction == 'back':
+                    r = 1.0 - r
+                row['mix'] = ( 1 - r ) * start_ratio + r * end_ratio
+            passes.append( rows )
+    return np.concatenate( passes )
+
+section_rows = {
+    '01': stage_01_rows,
+    '01_overlap': stage_01_overlap_rows,
+    '02': stage_02_rows,
+    '03a': stage_03a_rows,
+    '03b': stage_03b_rows,
+    'merge': merge_rows,
+}
+
+def table( *names ):
+    '''Returns rows for the named sections (keys of section_rows), or for the whole animation if
+    none are named, in the order given'''
+    names = names or list( section_rows )
+    return np.concatenate( [ section_rows[name]() for name in names ] )
+
+def select( rows, section, **values ):
+    '''Returns the rows of a section (name from sections), and optionally with fields equal to
+    values, e.g. select( rows, 'merge_fwd', pct = 98 )'''
+    chosen = rows['section'] == sections.index( section )
+    for field, value in values.items():
+        chosen &= rows[field] == value
+    return rows[chosen]
+
+def params( row ):
+    '''Returns dict of row values as plain Python numbers, as the stage scripts used before the
+    table existed, so that image arithmetic with them is unchanged'''
+    return dict( zip( row.dtype.names, row.item() ) )
+
+def objective_key( row ):
+    '''Returns objective key for row (a table row or dict from params), or None if it is not
+    rendered'''
+    if row['objective'] < 0:
+        return None
+    return objectives[ row['objective'] ]
+
+def target( row ):
+    '''Returns (layer, channel) that row renders, or for a blend the one being faded in'''
+    key = objective_key( row )
+    if key[2] == 'blend':
+        return key[1], row['channel_2']
+    return key[:2]
+
+def layers( rows ):
+    '''Returns sorted names of every layer that rows have objectives on'''
+    names = set()
+    for i in np.unique( rows['objective'] ):
+        if i >= 0:
+            key = objectives[i]
+            names.update( key[:2] if key[2] == 'blend' else key[:1] )
+    return sorted( names )
+
+def render_groups( rows ):
+    '''Groups rendered rows by the gradient op and render settings they need. Blend objectives
+    on the same pair of layers share one op, whatever the channels. Returns a list of
+    (objective key, renderer name, iter_n, first row, number of rows)'''
+    rendered = rows[ rows['objective'] >= 0 ]
+    groups = {}
+    for row in rendered:
+        group = ( int( row['objective'] ), int( row['renderer'] ), int( row['iter_n'] ) )
+        if group in groups:
+            groups[group][1] += 1
+        else:
+            groups[group] = [ row, 1 ]
+    return [ ( objectives[i], renderers[renderer], iter_n, row, count )
+             for ( i, renderer, iter_n ), ( row, count ) in sorted( groups.items() ) ]
+
+if __name__ == '__main__':
+    rows = table()
+    for section in sections:
+        chosen = rows[ rows['section'] == sections.index( section ) ]
+        print( '{}: {} frames, {} to {}'.format( section, len( chosen ), chosen['fno'].min(), chosen['fno'].max() ) )
+    for key, renderer, iter_n, row, count in render_groups( rows ):
+        print( '{} {} iter_n={}: {} frames'.format( key, renderer, iter_n, count ) )
@@ -37,146 +37,1021 @@
 ###############################################################################################
 
 import os
+import sys
 from io import BytesIO
 import numpy as np
 from functools import partial
 import PIL.Image
 import tensorflow as tf
-from skimage import transform, draw, filters
 import gc
 import math
+import threading
+import time
+import json
+import resource
+import multiprocessing
+import queue
+import atexit
+import contextlib
+import resample
+import masks
+import preview
+import schedule
 
-sess = None
+engine = None
+imagenet_mean = 117.0
 model_fn = 'inception/tensorflow_inception_graph.pb'
-with tf.gfile.FastGFile(model_fn, 'rb') as f:
-    inception_graph_string = f.read()
-
-# This re-loading is necessary to clear out the extra tensors and temp variables we create
-# during processing. Otherwise memory use can grow to many GB when processing 1000s of frames
-def reset_graph_and_session():
-    global sess, t_input
-
-    close_session()
-    gc.collect()
-
-    # Define new session, graph and input variable
-    sess = tf.Session()
-    t_input = tf.placeholder(np.float32, name='input')
-    imagenet_mean = 117.0
-    t_preprocessed = tf.expand_dims(t_input-imagenet_mean, 0)
-    graph_def = tf.GraphDef()
-    graph_def.ParseFromString( inception_graph_string )
-    tf.import_graph_def(graph_def, {'input':t_preprocessed})
 
-def close_session():
-    global sess, t_input
+# The model is only read and parsed when first needed, then shared by every engine, so that
+# importing this module stays fast for scripts that only use the image helpers
+inception_graph = None
+inception_graph_lock = threading.Lock()
+pruned_graphs = {}
 
-    # Clear existing TF data
-    if sess:
-        sess.close()
-    tf.reset_default_graph()
+def inception_graph_def( layers = None ):
+    '''Returns parsed GraphDef of the Inception model, loading it on first use. If layers
+    are given, the GraphDef is pruned to only the ops needed to compute those layers'''
+    global inception_graph
+    with inception_graph_lock:
+        if inception_graph is None:
+            graph_def = tf.GraphDef()
+            with tf.gfile.FastGFile(model_fn, 'rb') as f:
+                graph_def.ParseFromString( f.read() )
+            inception_graph = graph_def
+        if layers is None:
+            return inception_graph
 
-def savejpeg(a, name):
-    '''Writes image in Numpy array a to disk in JPEG format'''
-    a = np.uint8(np.clip(a/255.0, 0, 1)*255)
-    pil_img = PIL.Image.fromarray(a)
-    pil_img.save(name, 'jpeg')
-    pil_img.close()
+        key = frozenset( layers )
+        graph_def = pruned_graphs.get( key )
+        if graph_def is None:
+            graph_def = tf.graph_util.extract_sub_graph( inception_graph, sorted( key ) )
+            pruned_graphs[key] = graph_def
+        return graph_def
+
+def tile_mean( t_obj ):
+    '''Mean of t_obj over each tile in a batch, summed over the batch. Gradients of this
+    for a batch of tiles are the same as running each tile on its own'''
+    return tf.reduce_sum( tf.reduce_mean( t_obj, axis=tf.range( 1, tf.rank( t_obj ) ) ) )
+
+def objective_layers( key ):
+    '''Names of layers that an objective key depends on'''
+    if key[2] == 'blend':
+        return sorted( set( key[:2] ) )
+    return [ key[0] ]
+
+def input_layers( t_obj ):
+    '''Names of the model layers that tensor t_obj is computed from'''
+    layers = set()
+    seen = set()
+    ops = [ t_obj.op ]
+    while ops:
+        op = ops.pop()
+        if op.name in seen:
+            continue
+        seen.add( op.name )
+        if op.name.startswith( 'import/' ):
+            layers.add( op.name[ len('import/'): ] )
+        else:
+            ops.extend( t.op for t in op.inputs )
+    return sorted( layers )
+
+def resize_tensor( t_img, hw ):
+    '''Bicubic resize of a single image tensor to height and width in hw'''
+    return tf.image.resize_bicubic( tf.expand_dims( t_img, 0 ), hw )[0]
+
+# Optional instrumentation. When enabled, with enable_metrics or the TFI_METRICS environment
+# variable, engines record a row per render call and graph rebuild, and the rows are written
+# out as JSON lines each time a script calls flush_metrics. Rows are kept for the thread that
+# recorded them, so that the merge sweeps, which render at the same time, each flush only their own
+metrics_file = None
+metrics_pending = threading.local()
+metrics_lock = threading.Lock()
+
+def enable_metrics( filename ):
+    '''Starts recording per-call metrics, appended to filename as JSON lines by flush_metrics'''
+    global metrics_file
+    metrics_file = open( filename, 'a' )
+
+def process_rss_mb():
+    '''Resident memory of this process in MB. Falls back to peak resident memory where the
+    current figure is not available'''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int( f.read().split()[1] )
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1048576.0
+    except (IOError, OSError, ValueError):
+        return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024.0
+
+def pending_metrics():
+    '''Returns the list of rows recorded by the calling thread since its last flush_metrics'''
+    if not hasattr( metrics_pending, 'rows' ):
+        metrics_pending.rows = []
+    return metrics_pending.rows
+
+def record_metric( event, engine, start ):
+    '''Records time since start for an event on engine, with current memory and graph size'''
+    if metrics_file is None:
+        return
+    now = time.time()
+    row = { 'time': now, 'event': event, 'seconds': now - start, 'rss_mb': process_rss_mb() }
+    if engine.graph is not None:
+        row['graph_ops'] = len( engine.graph.get_operations() )
+        row['session_seconds'] = now - engine.session_start
+    pending_metrics().append( row )
+
+def flush_metrics( **frame_info ):
+    '''Writes metrics recorded by the calling thread to the log, followed by a summary row for
+    the frame described by frame_info (e.g. frame number). Does nothing unless metrics are enabled'''
+    if metrics_file is None:
+        return
+    rows = pending_metrics()
+    metrics_pending.rows = []
+    summary = { 'time': time.time(), 'event': 'frame', 'rss_mb': process_rss_mb(),
+                'seconds': sum( row['seconds'] for row in rows ) }
+    summary.update( frame_info )
+    with metrics_lock:
+        for row in rows + [ summary ]:
+            metrics_file.write( json.dumps( row ) + '\n' )
+        metrics_file.flush()
+
+if os.environ.get('TFI_METRICS'):
+    enable_metrics( os.environ['TFI_METRICS'] )
+
+# Best tile sizes for calc_grad_tiled are measured by Engine.tune_tile_size and kept on disk,
+# keyed by image size, layers, thread count and batching
+tile_profile_fn = 'tile_profile.json'
+default_tile_size = 512
+tile_candidates = ( 256, 320, 384, 448, 512, 640, 768 )
+tile_profile = None
+tile_profile_lock = threading.Lock()
+
+def load_tile_profile():
+    '''Returns dict of tuned tile sizes, read from disk on first use'''
+    global tile_profile
+    with tile_profile_lock:
+        if tile_profile is None:
+            tile_profile = {}
+            if os.path.exists( tile_profile_fn ):
+                with open( tile_profile_fn ) as f:
+                    tile_profile = json.load( f )
+        return tile_profile
+
+def save_tile_size( key, tile_size ):
+    '''Adds a tuned tile size to the profile and writes the profile to disk. Entries saved by
+    other processes (e.g. stages run together by run_stages.py) since it was read are kept'''
+    profile = load_tile_profile()
+    with tile_profile_lock:
+        profile[key] = tile_size
+        if os.path.exists( tile_profile_fn ):
+            with open( tile_profile_fn ) as f:
+                for other_key, other_size in json.load( f ).items():
+                    profile.setdefault( other_key, other_size )
+        tmp_fn = '{}.{}.tmp'.format( tile_profile_fn, os.getpid() )
+        with open( tmp_fn, 'w' ) as f:
+            json.dump( profile, f, indent=2, sort_keys=True )
+        os.replace( tmp_fn, tile_profile_fn )
+
+# Thread counts for the shared engine. run_stages.py sets these for each stage it runs, to match
+# the cores the stage is pinned to. 0 lets TensorFlow choose
+default_intra_op_threads = int( os.environ.get( 'TFI_INTRA_OP_THREADS', 0 ) )
+default_inter_op_threads = int( os.environ.get( 'TFI_INTER_OP_THREADS', 0 ) )
+
+# Compiled engines check their settings on a small gradient of this layer, or of their first
+# layer if they only load some
+trial_layer = 'mixed3a'
+trial_size = 224
+
+def available_cores():
+    '''Number of cores this process may run on, which is fewer than the machine has if it has
+    been pinned to some of them'''
+    try:
+        return len( os.sched_getaffinity(0) )
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+class Engine(object):
+    '''Owns a TensorFlow graph and session with the Inception model loaded, plus the gradient
+    ops built in that graph. Separate engines can render independently in the same process.
+    Thread counts of 0 let TensorFlow choose, opt_level is a tf.OptimizerOptions level, and
+    config can supply a complete tf.ConfigProto instead. If layers are given, only the part
+    of the model needed to compute those layers is loaded, which makes each frame cheaper
+    when all objectives are on lower layers. With tune_tiles, render_grad benchmarks tile
+    sizes for any image size that is not yet in the tile profile. Setting jit marks the gradient
+    ops for XLA compilation, and rewrites turns on aggressive grappler graph rewrites for the
+    session. Each new session runs a trial gradient with these, and if it fails, the engine warns
+    and carries on without them. Random tile
+    shifts are drawn from rng, a numpy RandomState, or the global numpy random state if not given,
+    so engines rendering in different threads can each keep a repeatable sequence'''
+
+    def __init__( self, intra_op_threads = 0, inter_op_threads = 0, opt_level = None, config = None,
+                  layers = None, tune_tiles = True, jit = False, rewrites = False, rng = None ):
+        self.layers = layers
+        self.rng = rng if rng is not None else np.random
+        self.jit = jit
+        self.rewrites = rewrites
+        self.compiled = jit or rewrites
+        self.tune_tiles = tune_tiles
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.opt_level = opt_level
+        self.config = config
+        self.sess = None
+        self.reset()
+
+    def session_config( self ):
+        '''Returns tf.ConfigProto for this engine's session, with rewrites unless compiled mode
+        has been turned off'''
+        if self.config is not None:
+            return self.config
+        config = tf.ConfigProto( intra_op_parallelism_threads=self.intra_op_threads,
+                                 inter_op_parallelism_threads=self.inter_op_threads )
+        if self.opt_level is not None:
+            config.graph_options.optimizer_options.opt_level = self.opt_level
+        if self.compiled and self.rewrites:
+            try:
+                from tensorflow.core.protobuf import rewriter_config_pb2
+                rewriter = rewriter_config_pb2.RewriterConfig
+                rewrite_options = config.graph_options.rewrite_options
+                rewrite_options.constant_folding = rewriter.ON
+                rewrite_options.arithmetic_optimization = rewriter.AGGRESSIVE
+                rewrite_options.dependency_optimization = rewriter.ON
+                rewrite_options.layout_optimizer = rewriter.ON
+                rewrite_options.remapping = rewriter.ON
+            except (ImportError, AttributeError, ValueError) as e:
+                print( 'Graph rewrites not available, continuing without: {}'.format( e ) )
+        return config
+
+    # This re-loading is necessary to clear out any extra tensors and temp variables created
+    # outside of the caches, e.g. by render_deepdream. Otherwise memory use can grow to many GB
+    # when processing 1000s of frames. Renders that use objective_grad re-use their gradient ops,
+    # so do not need periodic resets
+    def reset( self ):
+        '''Replaces graph and session with new ones, containing just the model'''
+        start = time.time()
+        self.close()
+        gc.collect()
+
+        # Define new session, graph and input variable
+        self.grad_cache = {}
+        self.dream_cache = {}
+        self.deepdream_grad = None
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.t_input = tf.placeholder(np.float32, name='input')
+            # Tiles of the same shape can be fed in here directly as a batch, instead of t_input
+            self.t_batch = tf.expand_dims(self.t_input, 0)
+            t_preprocessed = self.t_batch-imagenet_mean
+            self.graph_def = inception_graph_def( self.layers )
+            tf.import_graph_def(self.graph_def, {'input':t_preprocessed})
+
+            # Mix weights and channels for blend_grad objectives, fed per frame through blend_feed
+            self.t_blend_weights = tf.placeholder(np.float32, shape=[2], name='blend_weights')
+            self.t_blend_channels = tf.placeholder(np.int32, shape=[2], name='blend_channels')
+        try:
+            self.sess = tf.Session(graph=self.graph, config=self.session_config())
+            self.session_start = time.time()
+            if self.compiled:
+                self.trial_grad()
+        except (tf.errors.OpError, ValueError, AttributeError, ImportError) as e:
+            if not self.compiled:
+                raise
+            print( 'Compiled mode not available, continuing without: {}'.format( e ) )
+            self.compiled = False
+            self.reset()
+            return
+        record_metric( 'reset', self, start )
+
+    def trial_grad( self ):
+        '''Runs a gradient once on a small image. Jit and rewrite settings are only applied when
+        ops first run, so this makes any the installed TensorFlow cannot handle fail here instead
+        of part way through a render'''
+        layer = self.layers[0] if self.layers else trial_layer
+        t_grad = self.objective_grad( layer )
+        self.sess.run( t_grad, { self.t_batch: np.zeros( ( 1, trial_size, trial_size, 3 ), np.float32 ) } )
+
+    def jit_scope( self ):
+        '''Context for building gradient ops. With jit, the ops built inside are marked for XLA
+        compilation. Unlike a session wide jit level, this also compiles them on the CPU'''
+        if self.jit and self.compiled:
+            return tf.contrib.compiler.jit.experimental_jit_scope()
+        return contextlib.ExitStack()
+
+    def close( self ):
+        '''Closes session and releases graph'''
+        if self.sess:
+            self.sess.close()
+        self.sess = None
+        self.graph = None
+        self.grad_cache = {}
+        self.dream_cache = {}
+        self.deepdream_grad = None
+
+    def T( self, layer ):
+        '''Helper for getting layer output tensor'''
+        return self.graph.get_tensor_by_name("import/%s:0"%layer)
+
+    def calc_grad_tiled( self, img, t_grad, tile_size=512, feed=None, batched=False, active=None ):
+        '''Compute the value of tensor t_grad over the image in a tiled way.
+        Random shifts are applied to the image to blur tile boundaries over
+        multiple iterations. Any extra placeholder values are supplied in feed.
+        If batched, all tiles of the same shape are evaluated together in one run,
+        which needs a t_grad that scores each tile separately, as from objective_grad.
+        If active (a boolean array of image height and width) is given, tiles with no
+        active pixels are skipped and left with zero gradient'''
+        feed_dict = dict(feed) if feed else {}
+        sz = tile_size
+        h, w = img.shape[:2]
+        sx, sy = self.rng.randint(sz, size=2)
+        img_shift = np.roll(np.roll(img, sx, 1), sy, 0)
+        if active is not None:
+            active = np.roll(np.roll(active, sx, 1), sy, 0)
+        grad = np.zeros_like(img)
+        tiles = []
+        for y in range(0, max(h-sz//2, sz),sz):
+            for x in range(0, max(w-sz//2, sz),sz):
+                if active is None or active[y:y+sz,x:x+sz].any():
+                    tiles.append( (y, x) )
+
+        if batched:
+            # Edge tiles are smaller. They are not padded up to full size, because that changes
+            # the borders seen by the convolutions, so each distinct tile shape gets its own batch
+            batches = {}
+            for y, x in tiles:
+                batches.setdefault( img_shift[y:y+sz,x:x+sz].shape, [] ).append( (y, x) )
+        else:
+            batches = { i: [tile] for i, tile in enumerate(tiles) }
+
+        for batch_tiles in batches.values():
+            feed_dict[self.t_batch] = np.stack( [ img_shift[y:y+sz,x:x+sz] for y, x in batch_tiles ] )
+            g = self.sess.run(t_grad, feed_dict)
+            for i, (y, x) in enumerate(batch_tiles):
+                grad[y:y+sz,x:x+sz] = g[i]
+        return np.roll(np.roll(grad, -sx, 1), -sy, 0)
+
+    def objective_score( self, key ):
+        '''Builds score tensor for an objective key, either (layer, channel, kind) or
+        (layer_1, layer_2, 'blend')'''
+        if key[2] == 'blend':
+            layer_1, layer_2, _ = key
+            return ( self.t_blend_weights[0] * tile_mean( self.T(layer_1)[:,:,:,self.t_blend_channels[0]] ) +
+                     self.t_blend_weights[1] * tile_mean( self.T(layer_2)[:,:,:,self.t_blend_channels[1]] ) )
+
+        layer, channel, kind = key
+        t_obj = self.T(layer)
+        if channel is not None:
+            t_obj = t_obj[:,:,:,channel]
+        if kind == 'mean':
+            return tile_mean( t_obj )
+        elif kind == 'square':
+            return tile_mean( tf.square( t_obj ) )
+        else:
+            raise ValueError( 'Unknown objective kind {}'.format( kind ) )
+
+    def cached_grad( self, key ):
+        '''Returns gradient of objective key with respect to the input. Each key is only added to
+        the graph once per session, so repeated renders re-use the same ops instead of growing
+        the graph every frame'''
+        t_grad = self.grad_cache.get( key )
+        if t_grad is None:
+            start = time.time()
+            with self.graph.as_default():
+                t_score = self.objective_score( key )
+                with self.jit_scope():
+                    t_grad = tf.gradients(t_score, self.t_batch)[0]
+            self.grad_cache[key] = t_grad
+            record_metric( 'build_grad', self, start )
+        return t_grad
+
+    def grad_key( self, t_grad ):
+        '''Returns objective key that cached gradient t_grad was built from'''
+        for key, t_cached in self.grad_cache.items():
+            if t_cached is t_grad:
+                return key
+        raise ValueError( 'Gradient was not built by objective_grad or blend_grad' )
+
+    def objective_grad( self, layer, channel = None, kind = 'mean' ):
+        '''Returns cached gradient of a standard objective on layer (and optionally channel). Use
+        kind to choose between maximising the mean or the mean square of the layer values'''
+        return self.cached_grad( ( layer, channel, kind ) )
+
+    def blend_grad( self, layer_1, layer_2 ):
+        '''Returns cached gradient of a weighted mix of two channel objectives, for crossfading
+        between textures. Weights and channels are placeholders, set for each frame using
+        blend_feed, so one set of ops serves a whole crossfade section'''
+        return self.cached_grad( ( layer_1, layer_2, 'blend' ) )
+
+    def blend_feed( self, channel_1, channel_2, r ):
+        '''Returns feed values for blend_grad, with fraction r of the second objective'''
+        return { self.t_blend_weights: ( 1.0 - r, r ), self.t_blend_channels: ( channel_1, channel_2 ) }
+
+    def render_deepdream( self, t_obj, img0, iter_n=10, step=1.5, octave_n=4,
+                          octave_scale=1.4, verbose = False, direct_objective = False ):
+        '''Returns new image derived from img0, that has been changed to increase value of t_obj.
+        This adds new gradient ops to the graph on each call, render_grad with objective_grad does not.
+        Tile sizes come from the tile profile, keyed by the layers that t_obj is computed from'''
+
+        with self.graph.as_default():
+            if direct_objective:
+                t_score = t_obj
+            else:
+                t_score = tf.reduce_mean(t_obj)
+
+            with self.jit_scope():
+                t_grad = tf.gradients(t_score, self.t_batch)[0]
+        # Only the latest is kept, as each call makes a new gradient
+        self.deepdream_grad = ( t_grad, input_layers( t_obj ) )
+        return self.render_grad( t_grad, img0, iter_n, step, octave_n, octave_scale, verbose,
+                                 batched = False )
+
+    def grad_layers( self, t_grad ):
+        '''Names of layers that gradient t_grad depends on, for a cached gradient or the one made
+        by the latest render_deepdream'''
+        if self.deepdream_grad is not None and self.deepdream_grad[0] is t_grad:
+            return self.deepdream_grad[1]
+        return objective_layers( self.grad_key( t_grad ) )
+
+    def tile_profile_key( self, shape, t_grad, batched ):
+        '''Key for tile profile entries, from image shape, objective layers, threads and batching'''
+        layers = self.grad_layers( t_grad )
+        threads = self.intra_op_threads or available_cores()
+        return '{}x{}/{}/{}/{}'.format( shape[0], shape[1], '+'.join( layers ), threads,
+                                         'batched' if batched else 'single' )
+
+    def tune_tile_size( self, shape, t_grad, feed = None, batched = True, candidates = tile_candidates, repeats = 2 ):
+        '''Times calc_grad_tiled on a random image of the given shape for each candidate tile size,
+        saves the fastest to the tile profile and returns it'''
+        start = time.time()
+        # Keep the random sequence used by renders the same whether or not tuning happens
+        rng_state = self.rng.get_state()
+        img = self.rng.uniform( 0, 255, size=( shape[0], shape[1], 3 ) ).astype(np.float32)
+        timings = {}
+        for sz in candidates:
+            # First run at each size is a warm-up, as TensorFlow sets up for new tile shapes
+            self.calc_grad_tiled( img, t_grad, sz, feed, batched )
+            runs = []
+            for i in range(repeats):
+                run_start = time.time()
+                self.calc_grad_tiled( img, t_grad, sz, feed, batched )
+                runs.append( time.time() - run_start )
+            timings[sz] = min( runs )
+        self.rng.set_state( rng_state )
+
+        best = min( timings, key=timings.get )
+        save_tile_size( self.tile_profile_key( shape, t_grad, batched ), best )
+        record_metric( 'tune_tiles', self, start )
+        return best
+
+    def tile_size_for( self, shape, t_grad, feed = None, batched = True ):
+        '''Returns tile size to use for an image of the given shape, from the tile profile. Shapes
+        not in the profile are tuned first if tune_tiles is set, or get the default size'''
+        tile_size = load_tile_profile().get( self.tile_profile_key( shape, t_grad, batched ) )
+        if tile_size is None:
+            if self.tune_tiles:
+                tile_size = self.tune_tile_size( shape, t_grad, feed, batched )
+            else:
+                tile_size = default_tile_size
+        return tile_size
+
+    def render_grad( self, t_grad, img0, iter_n=10, step=1.5, octave_n=4,
+                     octave_scale=1.4, verbose = False, feed = None, batched = True, tile_size = None,
+                     roi = None, roi_margin = 32 ):
+        '''Returns new image derived from img0, following gradient t_grad (e.g. from objective_grad).
+        Values for any placeholders that t_grad depends on, such as from blend_feed, go in feed.
+        See calc_grad_tiled for batched. If tile_size is not given, each octave uses the size from
+        the tile profile, see tile_size_for.
+        If roi (a mask of img0 height and width, e.g. from ring_mask) is given, only the result
+        where it is non-zero is wanted. At each octave, tiles further than roi_margin pixels from
+        the mask are skipped, and the step size is set from the gradient inside the region.
+        For preview renders, octave_n is reduced to suit the smaller image, see preview.py'''
+        start = time.time()
+        octave_n = preview.octaves( octave_n, octave_scale )
+
+        # split the image into a number of octaves. The split makes new arrays, but with a single
+        # octave (e.g. at quarter preview scale) the steps would otherwise be added to img0 itself
+        img = img0 if octave_n > 1 else img0.copy()
+        octaves = []
+        for i in range(octave_n-1):
+            hw = img.shape[:2]
+            lo = resample.resize(img, np.int32(np.float32(hw)/octave_scale))
+            hi = img - resample.resize(lo, hw)
+            img = lo
+            octaves.append(hi)
+
+        # generate details octave by octave
+        for octave in range(octave_n):
+            if verbose:
+                print( '  octave {}'.format( octave ) )
+            if octave>0:
+                hi = octaves[-octave]
+                img = resample.resize(img, hi.shape[:2]) + hi
+            sz = tile_size or self.tile_size_for( img.shape, t_grad, feed, batched )
+            if roi is None:
+                active = None
+            else:
+                active = masks.active_region( roi, img.shape[:2], roi_margin )
+                if not active.any():
+                    continue
+            for i in range(iter_n):
+                g = self.calc_grad_tiled(img, t_grad, sz, feed=feed, batched=batched, active=active)
+                g_scale = np.abs(g).mean() if active is None else np.abs(g[active]).mean()
+                img += g*(step / (g_scale+1e-7))
+        record_metric( 'render_grad', self, start )
+        return img
+
+    def dream_ops( self, layers, octave_n, octave_scale ):
+        '''Builds ops that do the whole of render_grad inside TensorFlow, including the octave split
+        and merge, and the normalised gradient steps. The model is imported again inside a while
+        loop, so the gradient can be taken at each step without leaving the graph. The score is a
+        sum over layers of the per-channel weighted mean and mean square of each layer, with the
+        weights fed per frame from dream_feed, so one set of ops serves every objective on the
+        same layers. Returns placeholders for input image, step size, iterations per octave and
+        the weights of each layer, plus the output image tensor'''
+        ops_key = ( tuple( layers ), octave_n, octave_scale )
+        ops = self.dream_cache.get( ops_key )
+        if ops is not None:
+            return ops
+
+        start = time.time()
+        with self.graph.as_default():
+            t_img0 = tf.placeholder( np.float32, shape=[None, None, 3] )
+            t_step = tf.placeholder( np.float32, shape=[] )
+            t_iter_n = tf.placeholder( np.int32, shape=[] )
+            t_weights = {}
+            for layer in layers:
+                channels = int( self.T( layer ).get_shape()[-1] )
+                t_weights[layer] = ( tf.placeholder( np.float32, shape=[channels] ),
+                                     tf.placeholder( np.float32, shape=[channels] ) )
+
+            # split the image into a number of octaves
+            img = t_img0
+            octaves = []
+            for i in range(octave_n-1):
+                hw = tf.shape(img)[:2]
+                lo = resize_tensor( img, tf.to_int32( tf.to_float(hw)/octave_scale ) )
+                hi = img - resize_tensor( lo, hw )
+                img = lo
+                octaves.append(hi)
+
+            # details in the order they are added back, read from inside the loop
+            details = tf.TensorArray( tf.float32, size=max( octave_n-1, 1 ), infer_shape=False,
+                                      clear_after_read=False )
+            for octave in range(1, octave_n):
+                details = details.write( octave-1, octaves[-octave] )
+
+            def dream_step( i, img ):
+                if octave_n > 1:
+                    def add_detail():
+                        hi = details.read( i // t_iter_n - 1 )
+                        return resize_tensor( img, tf.shape(hi)[:2] ) + hi
+                    new_octave = tf.logical_and( i > 0, tf.equal( i % t_iter_n, 0 ) )
+                    img = tf.cond( new_octave, add_detail, lambda: img )
+
+                t_img_batch = tf.expand_dims( img, 0 )
+                outputs = tf.import_graph_def( self.graph_def, {'input':t_img_batch-imagenet_mean},
+                                               return_elements=[ '%s:0' % layer for layer in layers ] )
+                t_score = 0.0
+                for layer, t_layer in zip( layers, outputs ):
+                    t_mean, t_square = t_weights[layer]
+                    t_score += ( tile_mean( tf.reduce_sum( t_layer * t_mean, axis=-1 ) ) +
+                                 tile_mean( tf.reduce_sum( tf.square( t_layer ) * t_square, axis=-1 ) ) )
+                with self.jit_scope():
+                    g = tf.gradients( t_score, t_img_batch )[0][0]
+                img = img + g*( t_step / ( tf.reduce_mean( tf.abs( g ) )+1e-7 ) )
+                return i + 1, img
+
+            _, t_result = tf.while_loop( lambda i, img: i < octave_n * t_iter_n, dream_step,
+                                         [ tf.constant(0), img ],
+                                         shape_invariants=[ tf.TensorShape([]), tf.TensorShape([None, None, 3]) ],
+                                         back_prop=False )
+
+        ops = ( t_img0, t_step, t_iter_n, t_weights, t_result )
+        self.dream_cache[ops_key] = ops
+        record_metric( 'build_dream', self, start )
+        return ops
+
+    def dream_feed( self, key, t_weights, feed = None ):
+        '''Returns feed of the per-channel weights from dream_ops that score the same as objective
+        key. Blend weights and channels are read from feed, as made by blend_feed'''
+        weights = { layer: ( np.zeros( t_mean.get_shape().as_list(), np.float32 ),
+                             np.zeros( t_square.get_shape().as_list(), np.float32 ) )
+                    for layer, ( t_mean, t_square ) in t_weights.items() }
+        if key[2] == 'blend':
+            for layer, weight, channel in zip( key[:2], feed[self.t_blend_weights], feed[self.t_blend_channels] ):
+                weights[layer][0][channel] += weight
+        else:
+            layer, channel, kind = key
+            layer_weights = weights[layer][0 if kind == 'mean' else 1]
+            if channel is None:
+                # Mean over every channel
+                layer_weights[:] = 1.0 / layer_weights.size
+            else:
+                layer_weights[channel] = 1.0
+
+        feed_dict = {}
+        for layer, ( t_mean, t_square ) in t_weights.items():
+            feed_dict[t_mean], feed_dict[t_square] = weights[layer]
+        return feed_dict
+
+    def render_grad_in_graph( self, t_grad, img0, iter_n=10, step=1.5, octave_n=4,
+                              octave_scale=1.4, feed = None ):
+        '''Alternative to render_grad, for a gradient from objective_grad or blend_grad, that renders
+        the frame in a single TensorFlow run. Gradients are taken over the whole image at each octave
+        instead of in tiles, and octaves are resized in float32 by TensorFlow instead of skimage, so
+        results are close to, but not the same as, render_grad. Octaves are reduced for previews
+        in the same way as render_grad'''
+        start = time.time()
+        octave_n = preview.octaves( octave_n, octave_scale )
+        key = self.grad_key( t_grad )
+        t_img0, t_step, t_iter_n, t_weights, t_result = self.dream_ops( objective_layers( key ), octave_n, octave_scale )
+        feed_dict = self.dream_feed( key, t_weights, feed )
+        feed_dict[t_img0] = img0
+        feed_dict[t_step] = step
+        feed_dict[t_iter_n] = iter_n
+        img = self.sess.run(t_result, feed_dict)
+        record_metric( 'render_grad_in_graph', self, start )
+        return img
+
+    def scheduled_target( self, row ):
+        '''Returns gradient and feed (None unless a blend) for a row of the frame schedule, see
+        schedule.py'''
+        key = schedule.objective_key( row )
+        if key[2] == 'blend':
+            return self.cached_grad( key ), self.blend_feed( row['channel_1'], row['channel_2'], row['blend'] )
+        return self.cached_grad( key ), None
+
+    def render_scheduled( self, row, img, roi = None ):
+        '''Renders img as set out by a row of the frame schedule, with render_grad or
+        render_grad_in_graph. Ring rows only render tiles near roi'''
+        t_grad, feed = self.scheduled_target( row )
+        renderer = schedule.renderers[ row['renderer'] ]
+        if renderer == 'in_graph':
+            return self.render_grad_in_graph( t_grad, img, iter_n=row['iter_n'], step=row['step'],
+                                              octave_n=schedule.octave_n, octave_scale=schedule.octave_scale, feed=feed )
+        return self.render_grad( t_grad, img, iter_n=row['iter_n'], step=row['step'], octave_n=schedule.octave_n,
+                                 octave_scale=schedule.octave_scale, feed=feed,
+                                 roi=roi if renderer == 'ring' else None )
+
+    def prepare( self, rows, shape ):
+        '''Builds the gradient ops for every distinct render in rows of the frame schedule, and
+        runs each once on a random image of shape, so that graph building, tile tuning and
+        TensorFlow's own set-up are all done before the first frame. A second, timed render for
+        each layer and render setting gives a printed estimate of the time to render all rows,
+        which is returned in seconds. Ring renders are timed over the whole frame, so the estimate
+        for stages with rings is on the high side'''
+        start = time.time()
+        # Keep the random sequence used by renders the same whether or not warming happens
+        rng_state = self.rng.get_state()
+        img = self.rng.uniform( 0, 255, size=( shape[0], shape[1], 3 ) ).astype(np.float32)
+
+        timings = {}
+        estimate = 0.0
+        groups = schedule.render_groups( rows )
+        for key, renderer, iter_n, row, count in groups:
+            row = schedule.params( row )
+            row['renderer'] = schedule.renderers.index( 'tiled' if renderer == 'ring' else renderer )
+            self.render_scheduled( row, img.copy() )
+            timing_key = ( tuple( objective_layers( key ) ), renderer, iter_n )
+            if timing_key not in timings:
+                render_start = time.time()
+                self.render_scheduled( row, img.copy() )
+                timings[timing_key] = time.time() - render_start
+            estimate += count * timings[timing_key]
+
+        # Every frame is also warped once
+        warp_start = time.time()
+        affine_zoom( img, 1.001, 0.1 )
+        estimate += len( rows ) * ( time.time() - warp_start )
+        self.rng.set_state( rng_state )
+        record_metric( 'prepare', self, start )
+
+        print( 'Prepared {} gradient ops in {} render settings for {} frames in {:.0f}s, estimated render time {:.1f} hours'.format(
+            len( set( group[0] for group in groups ) ), len( groups ), len( rows ), time.time() - start, estimate / 3600.0 ) )
+        return estimate
+
+# The functions below use a shared default engine, for scripts that only need one render
+def default_engine():
+    '''Returns the shared engine, creating it on first use'''
+    global engine
+    if engine is None:
+        engine = Engine( intra_op_threads = default_intra_op_threads, inter_op_threads = default_inter_op_threads )
+    return engine
+
+def reset_graph_and_session( layers = None ):
+    '''Starts the shared engine afresh. If layers are given, it only loads the part of the model
+    needed for them, see Engine'''
+    global engine
+    if engine is None:
+        engine = Engine( intra_op_threads = default_intra_op_threads, inter_op_threads = default_inter_op_threads,
+                         layers = layers )
+    else:
+        if layers is not None:
+            engine.layers = layers
+        engine.reset()
+
+def close_session():
+    if engine:
+        engine.close()
 
 def T(layer):
     '''Helper for getting layer output tensor'''
-    return sess.graph.get_tensor_by_name("import/%s:0"%layer)
-
-def calc_grad_tiled(img, t_grad, tile_size=512):
-    '''Compute the value of tensor t_grad over the image in a tiled way.
-    Random shifts are applied to the image to blur tile boundaries over
-    multiple iterations.'''
-    sz = tile_size
-    h, w = img.shape[:2]
-    sx, sy = np.random.randint(sz, size=2)
-    img_shift = np.roll(np.roll(img, sx, 1), sy, 0)
-    grad = np.zeros_like(img)
-    for y in range(0, max(h-sz//2, sz),sz):
-        for x in range(0, max(w-sz//2, sz),sz):
-            sub = img_shift[y:y+sz,x:x+sz]
-            g = sess.run(t_grad, {t_input:sub})
-            grad[y:y+sz,x:x+sz] = g
-    return np.roll(np.roll(grad, -sx, 1), -sy, 0)
+    return default_engine().T(layer)
+
+def calc_grad_tiled(img, t_grad, tile_size=512, feed=None, batched=False, active=None):
+    return default_engine().calc_grad_tiled( img, t_grad, tile_size, feed, batched, active )
+
+def objective_grad( layer, channel = None, kind = 'mean' ):
+    return default_engine().objective_grad( layer, channel, kind )
+
+def blend_grad( layer_1, layer_2 ):
+    return default_engine().blend_grad( layer_1, layer_2 )
+
+def blend_feed( channel_1, channel_2, r ):
+    return default_engine().blend_feed( channel_1, channel_2, r )
 
 def render_deepdream(t_obj, img0, iter_n=10, step=1.5, octave_n=4,
                      octave_scale=1.4, verbose = False, direct_objective = False):
-    '''Returns new image derived from img0, that has been changed to increase value of t_obj'''
+    return default_engine().render_deepdream( t_obj, img0, iter_n, step, octave_n, octave_scale,
+                                              verbose, direct_objective )
 
-    if direct_objective:
-        t_score = t_obj
-    else:
-        t_score = tf.reduce_mean(t_obj)
-
-    t_grad = tf.gradients(t_score, t_input)[0]
-
-    # split the image into a number of octaves
-    img = img0
-    octaves = []
-    for i in range(octave_n-1):
-        hw = img.shape[:2]
-        lo = transform.resize(img, np.int32(np.float32(hw)/octave_scale), order=3,
-                 clip=False, preserve_range=True).astype(np.float32)
-        hi = img - transform.resize(lo, hw, order=3,
-                 clip=False, preserve_range=True).astype(np.float32)
-        img = lo
-        octaves.append(hi)
-
-    # generate details octave by octave
-    for octave in range(octave_n):
-        if verbose:
-            print( '  octave {}'.format( octave ) )
-        if octave>0:
-            hi = octaves[-octave]
-            img = transform.resize(img, hi.shape[:2], order=3,
-                 clip=False, preserve_range=True).astype(np.float32) + hi
-        for i in range(iter_n):
-            g = calc_grad_tiled(img, t_grad)
-            img += g*(step / (np.abs(g).mean()+1e-7))
-    return img
-
-def affine_zoom( img, zoom, spin = 0 ):
-    '''Returns new image derived from img, after a central-origin affine transform has been applied'''
-    img_copy = img.copy()
-
-    # Shift transforms allow Affine to be applied with centre of image as 0,0
-    shift_y, shift_x, _ = (np.array(img_copy.shape)-1) / 2.
-    shift_fwd = transform.SimilarityTransform(translation=[-shift_x, -shift_y])
-    shift_back = transform.SimilarityTransform(translation=[shift_x, shift_y])
-    affine = transform.AffineTransform( scale=(zoom, zoom), rotation=(spin * math.pi/180) )
-
-    img_copy = transform.warp( img_copy,
-                     ( shift_fwd + ( affine + shift_back )).inverse,
-                     order=3,
-                     clip=False, preserve_range=True,
-                     mode='reflect').astype(np.float32)
-    return img_copy
-
-def mix_images( img1, img2, r1 = 0.99 ):
-    '''Mixes two images according to fraction desired of first image'''
-    return ( img1 * r1 + img2 * (1 - r1 ) )
+def render_grad(t_grad, img0, iter_n=10, step=1.5, octave_n=4,
+                octave_scale=1.4, verbose = False, feed = None, batched = True, tile_size = None,
+                roi = None, roi_margin = 32):
+    return default_engine().render_grad( t_grad, img0, iter_n, step, octave_n, octave_scale,
+                                         verbose, feed, batched, tile_size, roi, roi_margin )
+
+def tune_tile_size( shape, t_grad, feed = None, batched = True, candidates = tile_candidates, repeats = 2 ):
+    return default_engine().tune_tile_size( shape, t_grad, feed, batched, candidates, repeats )
+
+def render_grad_in_graph(t_grad, img0, iter_n=10, step=1.5, octave_n=4,
+                         octave_scale=1.4, feed = None):
+    return default_engine().render_grad_in_graph( t_grad, img0, iter_n, step, octave_n,
+                                                  octave_scale, feed )
+
+def scheduled_target( row ):
+    return default_engine().scheduled_target( row )
+
+def render_scheduled( row, img, roi = None ):
+    return default_engine().render_scheduled( row, img, roi )
+
+def prepare_schedule( rows, shape ):
+    return default_engine().prepare( rows, shape )
+
+def jpeg_pixels(a):
+    '''Returns image in Numpy array a as clipped uint8 pixels, as written by savejpeg'''
+    return np.uint8(np.clip(a/255.0, 0, 1)*255)
+
+def write_jpeg(a, name):
+    pil_img = PIL.Image.fromarray(jpeg_pixels(a))
+    pil_img.save(name, 'jpeg')
+    pil_img.close()
+
+def savejpeg(a, name):
+    '''Writes image in Numpy array a to disk in JPEG format'''
+    write_jpeg(a, name)
+
+class FrameWriter(object):
+    '''Writes JPEG frames from background threads, so that clipping, encoding and disk writes
+    overlap with rendering of the next frame. Frames are copied when queued, so the caller can
+    reuse its array straight away. At most queue_size frames wait to be written, after which
+    savejpeg blocks until a thread catches up. An error in a writer thread stops further writes
+    and is raised by the next call to savejpeg or flush'''
+
+    def __init__( self, threads = 2, queue_size = 4 ):
+        self.queue = queue.Queue( maxsize = queue_size )
+        self.error = None
+        self.threads = [ threading.Thread( target = self.work, daemon = True ) for i in range(threads) ]
+        for thread in self.threads:
+            thread.start()
+
+    def work( self ):
+        while True:
+            a, name = self.queue.get()
+            try:
+                if self.error is None:
+                    self.write( a, name )
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def write( self, a, name ):
+        write_jpeg( a, name )
+
+    def check( self ):
+        '''Raises the first error from a writer thread, if there has been one since the last check'''
+        error = self.error
+        if error is not None:
+            self.error = None
+            raise error
+
+    def savejpeg( self, a, name ):
+        '''Queues image in Numpy array a to be written to disk in JPEG format'''
+        self.check()
+        self.queue.put( ( np.array(a), name ) )
+
+    def flush( self ):
+        '''Waits until all queued frames are written'''
+        self.queue.join()
+        self.check()
+
+frame_writer = None
+frame_writer_lock = threading.Lock()
+
+def savejpeg_async(a, name):
+    '''Queues image in Numpy array a to be written in JPEG format by the shared FrameWriter. Call
+    flush_frames before reading the file back. Frames still queued at exit are written then'''
+    global frame_writer
+    # The merge sweeps save their first frames at the same moment, and must share one writer
+    with frame_writer_lock:
+        if frame_writer is None:
+            frame_writer = FrameWriter()
+            atexit.register( flush_frames )
+    frame_writer.savejpeg( a, name )
+
+def flush_frames():
+    '''Waits until all frames from savejpeg_async are written, raising any error from writing them'''
+    if frame_writer is not None:
+        frame_writer.flush()
+
+checkpoint_every = 10
+
+def resume_requested():
+    '''True if the script was run with --resume, or with TFI_RESUME set in the environment'''
+    return '--resume' in sys.argv[1:] or bool( os.environ.get( 'TFI_RESUME' ) )
+
+class Checkpoint(object):
+    '''Saves the state of a stage script every few frames, so that a stopped run can continue with
+    --resume and produce the same frames. A checkpoint holds the full resolution state image, any
+    named values such as accumulated zoom and rotation, the position in the script as a section
+    and step, and the numpy random state that sets tile shifts. Sections are the names of the
+    script's frame loops, in the order they run. The position after every frame is also written
+    to progress.json in directory, for run_stages.py to follow. A script with several loops running
+    at once gives each its own checkpoint with a name, e.g. checkpoint_fwd.npz and
+    progress_fwd.json, and its own random state rng to save instead of the global one'''
+
+    def __init__( self, directory, sections, every = checkpoint_every, resume = None, name = None, rng = None ):
+        suffix = '_' + name if name else ''
+        self.filename = os.path.join( directory, 'checkpoint{}.npz'.format( suffix ) )
+        self.progress_filename = os.path.join( directory, 'progress{}.json'.format( suffix ) )
+        self.rng = rng if rng is not None else np.random
+        self.sections = list( sections )
+        self.every = every
+        self.state = None
+        if resume is None:
+            resume = resume_requested()
+        if resume and os.path.isfile( self.filename ):
+            with np.load( self.filename ) as data:
+                self.state = { key: data[key] for key in data.files }
+            print( 'Resuming from {} after {} step {}'.format( self.filename, self.state['section'],
+                                                                self.state['step'] ) )
+
+    def position( self ):
+        return ( self.sections.index( str( self.state['section'] ) ), int( self.state['step'] ) )
+
+    def done( self, section, step ):
+        '''True if step of section was completed before the checkpoint being resumed from'''
+        return self.state is not None and ( self.sections.index( section ), step ) <= self.position()
+
+    def started( self, section ):
+        '''True if the checkpoint being resumed from is in section or a later one'''
+        return self.state is not None and self.sections.index( section ) <= self.position()[0]
+
+    def resumes_in( self, section ):
+        '''True if the checkpoint being resumed from is in section'''
+        return self.state is not None and self.sections.index( section ) == self.position()[0]
+
+    def resume( self ):
+        '''Restores the random state and returns (img, values) from the checkpoint, or None if
+        not resuming. Call just before the first frame loop'''
+        if self.state is None:
+            return None
+        state = self.state
+        self.rng.set_state( ( str( state['rng_name'] ), state['rng_keys'], int( state['rng_pos'] ),
+                              int( state['rng_has_gauss'] ), float( state['rng_cached_gaussian'] ) ) )
+        values = { key[6:]: state[key].item() for key in state if key.startswith( 'value_' ) }
+        return state['img'], values
+
+    def save( self, section, step, img, **values ):
+        '''Writes a checkpoint after step of section is complete, if one is due. Queued frames are
+        written first, so that the frames before a checkpoint are always on disk'''
+        self.save_progress( section, step )
+        if ( step + 1 ) % self.every:
+            return
+        flush_frames()
+        rng_name, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = self.rng.get_state()
+        arrays = { 'value_' + key: value for key, value in values.items() }
+
+        # Written to a temporary file and then renamed, so that a crash while saving leaves the
+        # previous checkpoint in place
+        tmp_filename = '{}.{}.tmp.npz'.format( self.filename[:-4], os.getpid() )
+        np.savez( tmp_filename, img = img, section = section, step = step, rng_name = rng_name,
+                  rng_keys = rng_keys, rng_pos = rng_pos, rng_has_gauss = rng_has_gauss,
+                  rng_cached_gaussian = rng_cached_gaussian, **arrays )
+        os.replace( tmp_filename, self.filename )
+
+    def save_progress( self, section, step ):
+        '''Writes section and step just completed to the progress file'''
+        tmp_filename = '{}.{}.tmp'.format( self.progress_filename, os.getpid() )
+        with open( tmp_filename, 'w' ) as f:
+            json.dump( { 'section': section, 'step': step, 'time': time.time() }, f )
+        os.replace( tmp_filename, self.progress_filename )
+
+def affine_zoom( img, zoom, spin = 0, out = None ):
+    '''Returns new image derived from img, after a central-origin zoom and rotation (spin in
+    degrees) has been applied. Uses float32 bicubic resampling with reflect boundaries, see
+    resample.py. Written into out if supplied, which must not be img'''
+    return resample.affine_zoom( img, zoom, spin, out )
+
+# Compositing works through the frame a block of rows at a time, with small scratch buffers
+# that are kept between calls, so that mixing needs no full frame temporaries. Output can be
+# written into one of the inputs. Results are the same as the whole-array expressions. Each
+# thread has its own scratch buffers, so frames can be composited in several threads at once
+
+mix_block_rows = 32
+mix_scratch = threading.local()
+
+def mix_buffer( name, shape, dtype ):
+    '''Returns a reusable scratch array for one block of rows, kept for the calling thread'''
+    if not hasattr( mix_scratch, 'buffers' ):
+        mix_scratch.buffers = {}
+    key = ( name, tuple( shape ), np.dtype( dtype ) )
+    buf = mix_scratch.buffers.get( key )
+    if buf is None:
+        buf = np.empty( shape, dtype = dtype )
+        mix_scratch.buffers[key] = buf
+    return buf
+
+def mix_output( out, *arrays ):
+    if out is None:
+        out = np.empty( arrays[0].shape, dtype = np.result_type( *arrays ) )
+    return out
+
+def mix_images( img1, img2, r1 = 0.99, out = None ):
+    '''Mixes two images according to fraction desired of first image. Written into out if
+    supplied, which may be img1 or img2'''
+    out = mix_output( out, img1, img2 )
+    block_shape = ( min( mix_block_rows, out.shape[0] ), ) + out.shape[1:]
+    part = mix_buffer( 'part', block_shape, out.dtype )
+    for y in range( 0, out.shape[0], mix_block_rows ):
+        rows = slice( y, y + mix_block_rows )
+        out_rows = out[rows]
+        part_rows = part[:out_rows.shape[0]]
+        np.multiply( img1[rows], r1, out = part_rows )
+        np.multiply( img2[rows], 1 - r1, out = out_rows )
+        out_rows += part_rows
+    return out
 
 def circle_mask_blurred( img, radius, sig = 20 ):
-    '''Creates a blurred circle, using supplied image as template for dimensions'''
-    height, width, ch = img.shape
-    centre_y = (height-1) / 2.
-    centre_x = (width-1) / 2.
-    img_copy = img.copy()
-    img_copy[:, :, :] = (0.,0.,0.)
-    rr, cc = draw.circle(centre_y, centre_x, radius, img.shape)
-    img_copy[rr, cc, :] = (1.,1.,1.)
-    img_copy = filters.gaussian(img_copy, sigma=sig, mode='nearest', multichannel=True)
-    return img_copy
+    '''Returns single-channel blurred circle, using supplied image as template for dimensions.
+    Masks are computed analytically and cached on disk, see masks.py. Radius and blur are in
+    full size pixels, and are scaled for preview renders'''
+    return masks.circle_mask( img.shape, preview.scaled( radius ), preview.scaled( sig ) )
 
 def ring_mask( img, outer_radius, inner_radius ):
-    '''Creates a blurred ring, using supplied image as template for dimensions'''
-    return circle_mask_blurred( img, outer_radius ) - circle_mask_blurred( img, inner_radius )
+    '''Returns single-channel blurred ring, using supplied image as template for dimensions'''
+    return masks.ring_mask( img.shape, preview.scaled( outer_radius ), preview.scaled( inner_radius ),
+                            preview.scaled( 20 ) )
+
+def masked_mix( img_a, img_b, mask_img, mask_mul = 1.0, out = None ):
+    '''Combines img_a and img_b using mask_img to control how img_b pixels are mixed. A
+    single-channel mask is applied to every channel. Written into out if supplied, which may be
+    img_a or img_b'''
+    out = mix_output( out, img_a, img_b, mask_img )
+    block_shape = ( min( mix_block_rows, out.shape[0] ), ) + out.shape[1:]
+    part = mix_buffer( 'part', block_shape, out.dtype )
+    mask_shape = block_shape[:1] + mask_img.shape[1:]
+    mask = mix_buffer( 'mask', mask_shape, out.dtype )
+    inverse = mix_buffer( 'inverse', mask_shape, out.dtype )
+    for y in range( 0, out.shape[0], mix_block_rows ):
+        rows = slice( y, y + mix_block_rows )
+        out_rows = out[rows]
+        n = out_rows.shape[0]
+        np.multiply( mask_img[rows], mask_mul, out = mask[:n] )
+        np.subtract( 1.0, mask[:n], out = inverse[:n] )
+        np.multiply( img_a[rows], masks.broadcast( inverse[:n], out_rows ), out = part[:n] )
+        np.multiply( img_b[rows], masks.broadcast( mask[:n], out_rows ), out = out_rows )
+        out_rows += part[:n]
+    return out
+
+class FramePool(object):
+    '''A few preallocated float32 frame buffers, shared by a stage loop so that new frames do
+    not need fresh allocations. Buffers are taken for an output and given back once the frame
+    they hold is no longer needed'''
+
+    def __init__( self, shape, size = 3 ):
+        self.shape = tuple( shape )
+        self.buffers = [ np.empty( self.shape, dtype = np.float32 ) for i in range(size) ]
+        self.free = list( self.buffers )
+
+    def take( self ):
+        '''Returns a buffer with undefined contents. If all buffers are in use, a new array is
+        returned that is not kept by the pool'''
+        if self.free:
+            return self.free.pop()
+        return np.empty( self.shape, dtype = np.float32 )
 
-def masked_mix( img_a, img_b, mask_img, mask_mul = 1.0 ):
-    '''Combines img_a and img_b using mask_img to control how img_b pixels are mixed'''
-    mask = mask_img * mask_mul
-    return img_a * (1.0 - mask) + img_b * mask
+    def give( self, buf ):
+        '''Returns buf to the pool. Arrays that did not come from the pool, such as source images
+        or render output, are ignored, so any frame that is finished with can be passed in'''
+        if any( buf is b for b in self.buffers ) and not any( buf is b for b in self.free ):
+            self.free.append( buf )
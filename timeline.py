@@ -0,0 +1,121 @@
+###############################################################################################
+#   Copyright 2016, Neil Slater.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+###############################################################################################
+
+
+# Script works out which stage output supplies each frame of the final video, and points the video
+# build at those files without copying them. Stage outputs overlap (stage 1 runs on to frame 1200,
+# stage 2 runs back to 961, and the merge replaces 961 to 1190), so each frame is taken from the
+# source with highest precedence that has it. Writes either a folder of symlinks named
+# frame_XXXX.jpeg, for ffmpeg's image sequence input, or an ffmpeg concat list
+
+import preview
+import argparse
+import os
+import re
+import sys
+
+fps = 30
+
+# Lowest precedence first, same as the order the frames used to be copied in
+sources = [
+    'animation_stage_01',
+    'animation_stage_02',
+    'animation_merges/back_0',
+    'animation_stage_03',
+]
+
+frame_pattern = re.compile( r'^frame_(\d+)\.jpeg$' )
+
+def index_frames( sources ):
+    '''Returns dict of frame number to file, and dict of source to the frame numbers it owns'''
+    owners = {}
+    for source in sources:
+        if not os.path.isdir( source ):
+            print( 'Warning: {} not found'.format( source ) )
+            continue
+        for filename in os.listdir( source ):
+            match = frame_pattern.match( filename )
+            if match:
+                owners[ int( match.group(1) ) ] = os.path.join( source, filename )
+
+    owned = { source: [] for source in sources }
+    for fno, path in owners.items():
+        owned[ os.path.dirname( path ) ].append( fno )
+    return owners, owned
+
+def frame_ranges( frames ):
+    '''Returns sorted frame numbers as a list of (first, last) runs'''
+    ranges = []
+    for fno in sorted( frames ):
+        if ranges and fno == ranges[-1][1] + 1:
+            ranges[-1] = ( ranges[-1][0], fno )
+        else:
+            ranges.append( ( fno, fno ) )
+    return ranges
+
+def make_links( owners, directory ):
+    '''Replaces frame_XXXX.jpeg entries in directory with symlinks to the owning files'''
+    if not os.path.isdir( directory ):
+        os.makedirs( directory )
+    for filename in os.listdir( directory ):
+        if frame_pattern.match( filename ):
+            os.remove( os.path.join( directory, filename ) )
+    for fno, path in owners.items():
+        os.symlink( os.path.relpath( path, directory ),
+                    os.path.join( directory, 'frame_{}.jpeg'.format( '%04d' % fno ) ) )
+
+def write_concat_list( owners, filename ):
+    '''Writes an ffmpeg concat list showing each frame for 1/fps seconds, for use with
+    ffmpeg -f concat -safe 0 -i filename'''
+    with open( filename, 'w' ) as f:
+        f.write( 'ffconcat version 1.0\n' )
+        for fno in sorted( owners ):
+            f.write( "file '{}'\nduration {:.6f}\n".format( os.path.abspath( owners[fno] ), 1.0 / fps ) )
+        # The concat demuxer ignores the duration of the last entry, so it is repeated
+        if owners:
+            f.write( "file '{}'\n".format( os.path.abspath( owners[ max( owners ) ] ) ) )
+
+parser = argparse.ArgumentParser( description = 'Resolve final video frames from stage outputs' )
+parser.add_argument( '--links', metavar = 'DIR', help = 'write frame_XXXX.jpeg symlinks into DIR' )
+parser.add_argument( '--concat', metavar = 'FILE', help = 'write an ffmpeg concat list to FILE' )
+parser.add_argument( '--first', type = int, default = 0, help = 'first frame expected (default 0)' )
+parser.add_argument( '--last', type = int, help = 'last frame expected (default highest found)' )
+parser.add_argument( '--preview', type = float, metavar = 'SCALE', help = 'use the frames of a preview render' )
+args = parser.parse_args()
+
+if args.preview:
+    preview.set_scale( args.preview )
+# Preview renders put each script's output in its own renamed directory, e.g. animation_merges_x0.25
+sources = [ os.path.join( preview.output_dir( source.split('/')[0] ), *source.split('/')[1:] ) for source in sources ]
+owners, owned = index_frames( sources )
+for source in sources:
+    runs = ', '.join( '{}-{}'.format( a, b ) for a, b in frame_ranges( owned[source] ) )
+    print( '{}: {} frames {}'.format( source, len( owned[source] ), runs ) )
+
+last = args.last if args.last is not None else max( owners, default = args.first )
+missing = [ fno for fno in range( args.first, last + 1 ) if fno not in owners ]
+owners = { fno: path for fno, path in owners.items() if args.first <= fno <= last }
+if missing:
+    runs = ', '.join( '{}-{}'.format( a, b ) for a, b in frame_ranges( missing ) )
+    print( 'Error: {} frames missing between {} and {}: {}'.format( len( missing ), args.first, last, runs ) )
+    sys.exit( 1 )
+
+if args.links:
+    make_links( owners, args.links )
+    print( 'Linked {} frames in {}'.format( len( owners ), args.links ) )
+if args.concat:
+    write_concat_list( owners, args.concat )
+    print( 'Wrote concat list of {} frames to {}'.format( len( owners ), args.concat ) )